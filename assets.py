@@ -0,0 +1,79 @@
+'''Process-wide cache of images and textures loaded from disk, so a file is decoded and
+uploaded once however many objects use it. Entries are reference counted: release what you
+acquire, and evict frees whatever is no longer referenced.'''
+import pyglet
+import os
+
+
+class AssetCache(object):
+    def __init__(self):
+        self.entries = {} #key: [asset, references, keys of entries it depends on]
+        self.keys = {} #id(asset): key
+
+    def acquire(self, key, create, depends=()):
+        '''
+        Parameters:
+            key (hashable): identifies the asset
+            create (function): makes the asset on a cache miss
+            depends (tuple of keys): entries the asset was made from. Acquiring them is
+                create's job; they are released when this entry is evicted
+        Returns: the shared asset, with its reference count increased
+        '''
+        if key not in self.entries:
+            asset = create()
+            self.entries[key] = [asset, 0, depends]
+            self.keys[id(asset)] = key
+        entry = self.entries[key]
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, asset):
+        key = self.keys[id(asset)]
+        self.entries[key][1] -= 1
+
+    def evict(self, path=None):
+        '''
+        Drop unreferenced entries, for one file or all of them. Textures are deleted on the
+        GPU once nothing else holds them.
+        Returns: number of entries dropped
+        '''
+        if path is not None:
+            path = os.path.abspath(path)
+        dropped = 0
+        for key, (asset, references, depends) in self.entries.items():
+            if references > 0 or (path is not None and path not in key):
+                continue
+            del self.entries[key]
+            del self.keys[id(asset)]
+            dropped += 1
+            for dependency in depends:
+                self.entries[dependency][1] -= 1
+        if dropped:
+            #dependencies released above may now be unreferenced too
+            dropped += self.evict(path)
+        return dropped
+
+    def image(self, path):
+        '''decoded image for a file, for example for a sprite'''
+        return self.acquire(('image', os.path.abspath(path)), lambda: pyglet.image.load(path))
+
+    def texture(self, path):
+        '''texture for an image file. Uploaded from, and shared with, image(path)'''
+        image_key = ('image', os.path.abspath(path))
+        def create():
+            return self.image(path).get_texture()
+        return self.acquire(('texture', os.path.abspath(path)), create, (image_key,))
+
+    def solid_texture(self, width, height, color):
+        '''texture filled with one RGBA color (tuple of 4 int, 0 to 255)'''
+        def create():
+            pattern = pyglet.image.SolidColorImagePattern(tuple(color))
+            return pattern.create_image(width, height).get_texture()
+        return self.acquire(('solid', width, height, tuple(color)), create)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+#shared by every object that loads images
+cache = AssetCache()
@@ -0,0 +1,6 @@
+'''Reproducible timings of the hot paths. Run from the repository root:
+    python -m benchmarks.run --out before.json
+    (make a change)
+    python -m benchmarks.run --out after.json
+    python -m benchmarks.compare before.json after.json
+Every result is seconds per call, so lower is always better.'''
@@ -0,0 +1,54 @@
+'''Compares two benchmark result files and flags regressions. Exits with status 1 if any
+benchmark got slower than the threshold allows, so it can gate a CI job.'''
+import argparse
+import json
+import sys
+
+
+def compare(baseline, current, threshold=.1):
+    '''
+    Parameters:
+        baseline, current (dict): reports from benchmarks.run
+        threshold (float): relative slowdown that counts as a regression
+    Returns: list of (name, baseline seconds, current seconds, relative change, regressed),
+        for benchmarks present in both
+    '''
+    rows = []
+    before, after = baseline['results'], current['results']
+    for name in sorted(set(before) & set(after)):
+        old, new = before[name]['seconds'], after[name]['seconds']
+        change = (new - old)/old if old else 0.0
+        rows.append((name, old, new, change, change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='flag benchmark regressions')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=.1,
+                        help='relative slowdown that counts as a regression (default .1)')
+    args = parser.parse_args()
+    baseline = json.load(open(args.baseline))
+    current = json.load(open(args.current))
+    for label, report in (('baseline', baseline), ('current', current)):
+        meta = report['metadata']
+        print '%-9s %s %s python %s numpy %s' %(
+            label, meta.get('commit') or '?', meta['platform'], meta['python'], meta['numpy'])
+    if baseline['metadata']['host'] != current['metadata']['host']:
+        print 'warning: results come from different machines'
+    rows = compare(baseline, current, args.threshold)
+    print '%-40s %10s %10s %8s' %('benchmark', 'base ms', 'new ms', 'change')
+    for name, old, new, change, regressed in rows:
+        print '%-40s %10.4f %10.4f %+7.1f%%%s' %(
+            name, 1000*old, 1000*new, 100*change, '  REGRESSION' if regressed else '')
+    for name in sorted(set(baseline['results']) ^ set(current['results'])):
+        print '%-40s only in %s' %(name, 'baseline' if name in baseline['results'] else
+                                   'current')
+    regressions = [row for row in rows if row[4]]
+    if regressions:
+        print '%i regression(s) over %i%%' %(len(regressions), 100*args.threshold)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
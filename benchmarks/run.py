@@ -0,0 +1,220 @@
+'''Times mesh generation, page turning and OBJ parsing at several grid sizes, plus a scripted
+headless session where a GL context can be created, and writes the results as JSON with
+details of the machine. See benchmarks/__init__.py for usage.'''
+import pyglet
+#the CPU benchmarks need no GL context, so don't let pyglet open its hidden shadow window,
+#which fails outright on machines without a display. The headless session runs separately
+pyglet.options['shadow_window'] = False
+import numpy as np
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import time
+import StringIO
+import geometry
+from wave_parser import WaveParser
+
+SIZES = [50, 100, 200, 400]
+PAGE_SIZE = 500
+
+
+def measure(function, repeat=5, min_time=.1):
+    '''
+    Calls function in loops long enough to time reliably.
+    Returns: dict with the best and median seconds per call
+    '''
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            function()
+        elapsed = time.time() - start
+        if elapsed >= min_time or number >= 2**20:
+            break
+        number *= 2
+    times = [elapsed/number]
+    for i in range(repeat - 1):
+        start = time.time()
+        for j in xrange(number):
+            function()
+        times.append((time.time() - start)/number)
+    return {'seconds': min(times), 'median': float(np.median(times)), 'number': number,
+            'repeat': repeat}
+
+
+def geometry_benchmarks(sizes):
+    curve = geometry.PageCurve(PAGE_SIZE)
+    for size in sizes:
+        length = PAGE_SIZE*1.0/size
+        yield ('geometry.make_indices[%i]' %size,
+               lambda size=size: geometry.make_indices(size, size))
+        yield ('geometry.make_vertices[%i]' %size,
+               lambda size=size, length=length:
+                   geometry.make_vertices(size, size, length, curve, seed=0))
+        vertices, normals = geometry.make_vertices(size, size, length, curve, seed=0)
+        yield ('geometry.make_tex_coords[%i]' %size,
+               lambda vertices=vertices: geometry.make_tex_coords(vertices))
+        angles = .5*geometry.get_flap_angles(size, curve)
+        yield ('geometry.flap[%i]' %size,
+               lambda vertices=vertices, angles=angles:
+                   geometry.flap(vertices, [0, 1, 0], angles))
+        yield ('geometry.flap_pair[%i]' %size,
+               lambda vertices=vertices, normals=normals, angles=angles:
+                   geometry.flap_pair(vertices, normals, [0, 1, 0], angles))
+
+
+class TurnTarget(object):
+    '''stands in for a Page, so turns are timed without a GL context or vertex upload'''
+    def __init__(self):
+        self.right_side = True
+        self.face_up = True
+        self.curl = None
+        self.mesh = self
+
+    def update_vertices(self, vertices):
+        self.vertices = vertices
+
+    def update_normals(self, normals):
+        self.normals = normals
+
+
+def turn_benchmarks(frames=60):
+    import page
+    def turn(keyframes):
+        def run():
+            turner = page.PageTurner(TurnTarget(), 0, 1.0, True)
+            turner.keyframes = keyframes
+            for i in xrange(frames):
+                turner.on_update(None, 1.0/frames)
+        return run
+    #per frame, so the numbers compare with the frame budget
+    yield 'PageTurner.on_update[exact]', turn(None), frames
+    yield 'PageTurner.on_update[keyframes]', turn(page.PageTurner.keyframes), frames
+
+
+def synthetic_obj(size):
+    '''OBJ text for a size by size grid of textured quads'''
+    lines = ['o synthetic', 'vn 0 0 1']
+    coordinates = np.arange(size + 1)*1.0/size
+    for y in coordinates:
+        for x in coordinates:
+            lines.append('v %f %f 0' %(x, y))
+            lines.append('vt %f %f' %(x, y))
+    for row in range(size):
+        for column in range(size):
+            a = row*(size + 1) + column + 1
+            b, c, d = a + 1, a + size + 2, a + size + 1
+            lines.append('f %i/%i/1 %i/%i/1 %i/%i/1 %i/%i/1' %(a, a, b, b, c, c, d, d))
+    return '\n'.join(lines) + '\n'
+
+
+def parser_benchmarks(sizes):
+    for path in sorted(glob.glob('imagery/*.obj')):
+        yield ('WaveParser.parse[%s]' %os.path.basename(path),
+               lambda path=path: WaveParser().parse(open(path)))
+    for size in sizes:
+        text = synthetic_obj(size)
+        yield ('WaveParser.parse[synthetic %i]' %size,
+               lambda text=text: WaveParser().parse(StringIO.StringIO(text)))
+
+
+def headless_benchmark(frames):
+    '''
+    Runs headless.py in its own process, since it needs a real GL context and pyglet options
+    set before any GL import.
+    Returns: result dict in seconds per frame, or raises RuntimeError with the reason
+    '''
+    command = [sys.executable, 'headless.py', '--flips', '100', '--pause', '5',
+               '--max-frames', str(frames)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    match = re.search(r'(\d+) frames in ([\d.]+) s', output)
+    if process.returncode or not match:
+        lines = errors.strip().splitlines() or ['exit status %i' %process.returncode]
+        raise RuntimeError, lines[-1]
+    drawn, seconds = int(match.group(1)), float(match.group(2))
+    return {'seconds': seconds/drawn, 'median': seconds/drawn, 'number': drawn, 'repeat': 1}
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': datetime.datetime.now().isoformat(),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pyglet': pyglet.version,
+        'commit': commit,
+        }
+
+
+def run(sizes=SIZES, only=None, repeat=5, min_time=.1, headless_frames=120, log=sys.stdout):
+    '''
+    Parameters:
+        only (None or str): run only benchmarks whose name contains this
+        headless_frames (int): frames for the headless session, 0 to skip it
+    Returns: dict with 'metadata', 'results' and 'skipped' (name: reason)
+    '''
+    results = {}
+    skipped = {}
+    def time_all(benchmarks):
+        for benchmark in benchmarks:
+            name, function = benchmark[:2]
+            calls = benchmark[2] if len(benchmark) > 2 else 1
+            if only and only not in name:
+                continue
+            result = measure(function, repeat, min_time)
+            result['seconds'] /= calls
+            result['median'] /= calls
+            results[name] = result
+            log.write('%-40s %10.4f ms\n' %(name, 1000*result['seconds']))
+
+    time_all(geometry_benchmarks(sizes))
+    try:
+        time_all(turn_benchmarks())
+    except Exception, error:
+        #report rather than abort if page can't be imported on this machine
+        skipped['PageTurner.on_update'] = repr(error)
+    time_all(parser_benchmarks(sizes))
+    name = 'headless.frame'
+    if headless_frames and not (only and only not in name):
+        try:
+            results[name] = headless_benchmark(headless_frames)
+            log.write('%-40s %10.4f ms\n' %(name, 1000*results[name]['seconds']))
+        except RuntimeError, error:
+            skipped[name] = str(error)
+    for name, reason in sorted(skipped.items()):
+        log.write('%-40s skipped: %s\n' %(name, reason))
+    return {'metadata': metadata(), 'results': results, 'skipped': skipped}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='time the hot paths')
+    parser.add_argument('--out', default=None, help='JSON file for the results')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--only', default=None, help='substring of benchmark names to run')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=.1,
+                        help='seconds each timing loop runs for at least')
+    parser.add_argument('--headless-frames', type=int, default=120)
+    args = parser.parse_args()
+    report = run(args.sizes, args.only, args.repeat, args.min_time, args.headless_frames)
+    if args.out:
+        with open(args.out, 'w') as out:
+            json.dump(report, out, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 import pyglet
 from pyglet.gl import *
+import stats
+import numpy as np
+from math import tan, radians
 '''Two camera classes for setting up OpenGL views. SimpleCamera is strictly 2D and is designed
 to render to a texture. Camera is a full 3D camera with an HUD mode for drawing 2D elements'''
 
@@ -15,6 +18,7 @@ class SimpleCamera:
         glLoadIdentity()
         gluOrtho2D(0, self.width, 0, self.height)
         glEnable(GL_LIGHTING)
+        stats.counters.count('state_changes')
 
     def hud_mode(self):
         glMatrixMode(GL_MODELVIEW)
@@ -23,6 +27,7 @@ class SimpleCamera:
         glLoadIdentity()
         gluOrtho2D(0, self.width, 0, self.height)
         glDisable(GL_LIGHTING)
+        stats.counters.count('state_changes')
     
 
 class Camera:
@@ -56,6 +61,57 @@ class Camera:
         glLoadIdentity()
         gluPerspective(self.field_of_view, self.aspect, 1, 5000)
         glEnable(GL_LIGHTING)
+        stats.counters.count('state_changes')
+
+    def basis(self):
+        '''Returns: (eye, forward, right, up) as numpy arrays, the directions unit length'''
+        eye = np.asarray(self.eye, float)
+        forward = np.asarray(self.target, float) - eye
+        forward /= np.linalg.norm(forward)
+        right = np.cross(forward, [0, 1, 0])
+        right /= np.linalg.norm(right)
+        up = np.cross(right, forward)
+        return eye, forward, right, up
+
+    def unproject(self, x, y):
+        '''
+        Parameters:
+            x, y (float): window coordinates
+        Returns: (origin, direction), the ray in world space through the center of pixel (x, y)
+        '''
+        eye, forward, right, up = self.basis()
+        #field_of_view is the vertical angle, as gluPerspective uses it
+        scale = tan(radians(self.field_of_view)/2)
+        ndc_x = 2*(x + .5)/self.width - 1
+        ndc_y = 2*(y + .5)/self.height - 1
+        direction = forward + scale*(ndc_x*self.aspect*right + ndc_y*up)
+        return eye, direction/np.linalg.norm(direction)
+
+    def project(self, points):
+        '''
+        The inverse of unproject.
+        Parameters:
+            points (array of shape (..., 3)): world positions in front of the camera
+        Returns: array of shape (..., 2), window coordinates of the points
+        '''
+        eye, forward, right, up = self.basis()
+        relative = np.asarray(points, float) - eye
+        depth = np.dot(relative, forward)
+        scale = tan(radians(self.field_of_view)/2)
+        ndc_x = np.dot(relative, right)/(depth*scale*self.aspect)
+        ndc_y = np.dot(relative, up)/(depth*scale)
+        return np.dstack(((ndc_x + 1)*self.width/2 - .5,
+                          (ndc_y + 1)*self.height/2 - .5)).reshape(depth.shape + (2,))
+
+    def pick_focus(self, x, y, size=1):
+        '''the 3D mode, zoomed so that a size by size viewport shows only the window pixels
+        around (x, y). Used for rendering small picking buffers'''
+        self.focus()
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        viewport = (GLint * 4)(0, 0, self.width, self.height)
+        gluPickMatrix(x + .5, y + .5, size, size, viewport)
+        gluPerspective(self.field_of_view, self.aspect, 1, 5000)
 
     def hud_mode(self):
         '''no lighting or view transformations will be applied'''
@@ -65,3 +121,4 @@ class Camera:
         glLoadIdentity()
         gluOrtho2D(0, self.width, 0, self.height)
         glDisable(GL_LIGHTING)
+        stats.counters.count('state_changes')
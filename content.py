@@ -0,0 +1,156 @@
+'''Generates and lays out page text on worker threads, so a long book opens at once instead
+of freezing the window while every page is written. Pages are worked on in order of
+distance from the focus page, normally the open spread, and finished pages are handed back
+to the render thread, which only has to upload their glyph quads. The workers share the
+interpreter lock with the render thread, so this keeps the window responsive rather than
+making generation itself faster.'''
+import atexit
+import heapq
+import logging
+import threading
+import traceback
+import Queue
+import pagetext
+from pagesource import lorem_page
+
+log = logging.getLogger(__name__)
+
+
+class ContentPipeline(object):
+    def __init__(self, generate=lorem_page, workers=2, x=100, y=924, width=824,
+                 font_name='Summertime', font_size=30, color=(20, 12, 8, 200)):
+        '''
+        Parameters:
+            generate (function): page number -> text. Called on a worker thread
+            workers (int): number of worker threads
+            x, y, width, font_name, font_size, color: passed on to pagetext.PageText
+        '''
+        self.generate = generate
+        self.worker_count = workers
+        self.x = x
+        self.y = y
+        self.width = width
+        self.font_name = font_name
+        self.font_size = font_size
+        self.color = color
+        self.metrics = None #(advances, line_height, tab, space width), copied in start
+        self.focus_page = 0
+        self.waiting = set() #page numbers requested and not yet taken by a worker
+        self.queue = [] #heap of (distance from focus_page, page number)
+        self.busy = 0 #pages being worked on
+        self.condition = threading.Condition()
+        self.results = Queue.Queue() #(page number, text, glyph positions)
+        self.errors = {} #page number: traceback of the last failure preparing it
+        self.workers = []
+        self.stopped = False
+
+    def start(self):
+        '''Copy the glyph metrics the workers lay out with and start them. Call on the
+        render thread, since building the atlas needs the GL context'''
+        if self.workers:
+            return
+        atlas = pagetext.get_atlas(self.font_name, self.font_size)
+        self.metrics = (dict(atlas.advances), atlas.line_height, atlas.tab,
+                        atlas.advances[' '])
+        for i in range(self.worker_count):
+            worker = threading.Thread(target=self.work, name='content worker %i' %i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        #workers left waiting at interpreter shutdown raise errors on the way out
+        atexit.register(self.stop)
+
+    def stop(self):
+        '''end the workers once they finish their current page'''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def distance(self, number):
+        return abs(number - self.focus_page)
+
+    def request(self, numbers):
+        '''queue pages to be prepared'''
+        with self.condition:
+            for number in numbers:
+                if number not in self.waiting:
+                    self.waiting.add(number)
+                    heapq.heappush(self.queue, (self.distance(number), number))
+            self.condition.notify_all()
+
+    def cancel(self, numbers):
+        '''drop queued pages that are no longer needed. Pages already taken still finish'''
+        with self.condition:
+            self.waiting.difference_update(numbers)
+            self.queue = [(self.distance(number), number) for number in self.waiting]
+            heapq.heapify(self.queue)
+
+    def focus(self, number):
+        '''prepare pages nearest number first'''
+        with self.condition:
+            self.focus_page = number
+            self.queue = [(self.distance(number), number) for number in self.waiting]
+            heapq.heapify(self.queue)
+
+    def work(self):
+        advances, line_height, tab, space = self.metrics
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                distance, number = heapq.heappop(self.queue)
+                self.waiting.discard(number)
+                self.busy += 1
+            try:
+                text = self.generate(number)
+                positions = pagetext.layout(text, advances, self.width, line_height, tab,
+                                            space)
+                self.results.put((number, text, positions))
+            except Exception:
+                #keep the worker alive, and hand the page back without text so it isn't
+                #left waiting forever
+                self.errors[number] = traceback.format_exc()
+                log.exception('preparing page %i failed', number)
+                self.results.put((number, None, None))
+            finally:
+                with self.condition:
+                    self.busy -= 1
+                    self.condition.notify_all()
+
+    def ready(self):
+        '''whether collect has pages to return'''
+        return not self.results.empty()
+
+    def pending(self):
+        return len(self.waiting) + self.busy
+
+    def join(self):
+        '''block until every requested page is prepared'''
+        with self.condition:
+            while (self.waiting or self.busy) and not self.stopped:
+                self.condition.wait()
+
+    def collect(self):
+        '''
+        Call on the render thread.
+        Returns: list of (page number, pagetext.PageText) for pages finished since the last
+            call. Their vertex lists are built when first drawn. Pages that failed come
+            with None instead, and the reason in errors
+        '''
+        pages = []
+        while True:
+            try:
+                number, text, positions = self.results.get_nowait()
+            except Queue.Empty:
+                return pages
+            if text is None:
+                pages.append((number, None))
+                continue
+            pages.append((number, pagetext.PageText(
+                text, self.x, self.y, self.width, self.font_name, self.font_size, self.color,
+                positions)))
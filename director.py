@@ -1,22 +1,115 @@
 import pyglet
 import framebuffer
 import lights
+import stats
+import profiling
 '''Stage management classes. The extra layer of abstraction is useful for extending to a more
 complicated game.'''
 
 class Director(object):
     '''The head honcho. Just one should be needed per game'''
-    def __init__(self):
+    def __init__(self, fixed_step=None, max_steps=5):
+        '''
+        Parameters:
+            fixed_step (None or float): if given, tick advances the simulation in steps of
+                exactly this many seconds, however long frames take, and scenes are drawn
+                interpolated between the last two steps. Otherwise each tick is one update
+            max_steps (int): most fixed steps per tick. Time beyond that is dropped, so a
+                long stall slows the animation down instead of making it jump
+        '''
         self.scenes = []
         self.active_scene = None
-
+        self.fixed_step = fixed_step
+        self.max_steps = max_steps
+        self.accumulator = 0.0
+        self.alpha = 1.0 #how far drawing is from the previous step to the latest
+        self.snapshot = None #last frame, once watch has been called
+        self.invalid = True #input arrived since the last drawn frame
+
+    def tick(self, dt):
+        '''advance the simulation by dt seconds of real time'''
+        if self.fixed_step is None:
+            self.update(dt)
+            return
+        self.accumulator += dt
+        steps = 0
+        while self.accumulator >= self.fixed_step and steps < self.max_steps:
+            self.update(self.fixed_step)
+            self.accumulator -= self.fixed_step
+            steps += 1
+        if steps == self.max_steps:
+            self.accumulator = min(self.accumulator, self.fixed_step)
+        self.alpha = self.accumulator/self.fixed_step
+
+    @profiling.profiler.timed('Director.update')
     def update(self, dt):
+        '''one simulation step'''
         if self.active_scene:
             self.active_scene.update(dt)
 
+    @profiling.profiler.timed('Director.draw')
     def draw(self):
         if self.active_scene:
+            if self.fixed_step is not None:
+                self.active_scene.interpolate(self.alpha)
             self.active_scene.draw()
+        stats.counters.new_frame()
+
+    #window events after which the frame is redrawn, whatever the scene reports
+    input_events = ('on_key_press', 'on_key_release', 'on_text', 'on_mouse_press',
+                    'on_mouse_release', 'on_mouse_drag', 'on_mouse_motion', 'on_mouse_scroll',
+                    'on_resize', 'on_expose', 'on_show', 'on_activate')
+
+    def watch(self, window):
+        '''Start redrawing window only when needed: after input, or while the active scene
+        reports changes with needs_redraw. Use present as the window's on_draw handler'''
+        self.snapshot = framebuffer.FrameSnapshot(window.width, window.height)
+        def invalidate(*args):
+            self.invalid = True
+        def resize(width, height):
+            self.snapshot.resize(width, height)
+            self.invalid = True
+        handlers = dict([(name, invalidate) for name in self.input_events])
+        handlers['on_resize'] = resize
+        window.push_handlers(**handlers)
+
+    def needs_redraw(self):
+        return (self.invalid or self.snapshot is None or not self.snapshot.valid or
+                (self.active_scene is not None and self.active_scene.needs_redraw()))
+
+    def present(self, window):
+        '''draw the frame if anything changed, otherwise put the last one back on screen'''
+        if not self.needs_redraw():
+            self.snapshot.present()
+            stats.counters.count('idle_frames')
+            stats.counters.new_frame()
+            return
+        self.invalid = False
+        window.clear()
+        self.draw()
+        if self.snapshot is not None:
+            self.snapshot.capture()
+
+    def schedule(self, window, render_cap=60, vsync=None):
+        '''
+        Drive the director from pyglet's clock. pyglet redraws the window after every tick,
+        so this also paces drawing.
+        Parameters:
+            window (pyglet.window.Window)
+            render_cap (None or float): most frames per second. None ticks on every pass of
+                the event loop
+            vsync (None or bool): if given, turn the window's vsync on or off. When vsync is on
+                and the cap is at or above the display's refresh rate, buffer flips already
+                pace the loop, so ticks aren't scheduled on a separate timer that would
+                drift against the display and drop frames
+        '''
+        if vsync is not None:
+            window.set_vsync(vsync)
+        pyglet.clock.unschedule(self.tick)
+        if not render_cap or (window.vsync and render_cap >= refresh_rate(window)):
+            pyglet.clock.schedule(self.tick)
+        else:
+            pyglet.clock.schedule_interval(self.tick, 1.0/render_cap)
 
     def add_scene(self, scene):
         self.scenes.append(scene)
@@ -30,6 +123,19 @@ class Director(object):
         if not scene in self.scenes:
             self.scenes.append(scene)
         self.active_scene = scene
+        scene.interpolated = self.fixed_step is not None
+
+
+def refresh_rate(window, default=60):
+    '''display refresh rate in Hz, or default where the platform doesn't report a sensible one'''
+    try:
+        rate = window.screen.get_mode().rate
+    except Exception:
+        return default
+    #some platforms report the pixel clock here instead
+    if rate and 20 <= rate <= 500:
+        return rate
+    return default
 
 
 class Scene(pyglet.event.EventDispatcher):
@@ -41,19 +147,59 @@ class Scene(pyglet.event.EventDispatcher):
         self.lightSet = lights.LightSet()
         self.world_objects = [] #drawn with lighting and camera applied
         self.hud_objects = [] #drawn without camera or lighting
+        self.batch = None #optional pyglet Batch drawn with the world objects
         self.camera = camera
+        #set by a fixed-step Director. Updaters can then leave drawn state to 'on_interpolate'
+        self.interpolated = False
+        self.updaters = []
+        self.changed = True #something was added or removed since the last draw
 
     def draw(self):
+        self.changed = False
         self.camera.focus()
         self.lightSet.draw()
+        if self.batch is not None:
+            self.draw_batch()
         for obj in self.world_objects:
             obj.draw()
         self.camera.hud_mode()
         for obj in self.hud_objects:
             obj.draw()
 
+    @profiling.profiler.timed('Scene.draw_batch')
+    def draw_batch(self):
+        '''draw the world objects sharing the batch, whose own draw methods aren't called'''
+        self.batch.draw()
+
+    @profiling.profiler.timed('Scene.update')
     def update(self, dt):
-        self.dispatch_event('on_update', self, dt)
+        if not profiling.profiler.enabled:
+            self.dispatch_event('on_update', self, dt)
+            return
+        #dispatch as pyglet does, timing each updater under its class name
+        for frame in list(self._event_stack):
+            handler = frame.get('on_update')
+            if not handler:
+                continue
+            owner = getattr(handler, 'im_self', None)
+            name = type(owner).__name__ + '.on_update' if owner is not None else handler.__name__
+            if profiling.profiler.call(name, handler, self, dt):
+                return
+
+    def interpolate(self, alpha):
+        '''called before drawing by a fixed-step Director. alpha (0 to 1) is how far between
+        the previous and latest simulation steps the frame should show'''
+        self.dispatch_event('on_interpolate', self, alpha)
+
+    def needs_redraw(self):
+        '''whether the scene would look different if drawn again: contents or lights changed
+        or an updater is running'''
+        if self.changed or self.lightSet.changed():
+            return True
+        for updater in self.updaters:
+            if updater.active and not updater.dead:
+                return True
+        return False
 
     def add_updater(self, updater, start=True, end_behavior=None):
         def end(updater, target): self.remove_updater(updater)
@@ -64,29 +210,38 @@ class Scene(pyglet.event.EventDispatcher):
             self.on_end = self.default_on_end
         updater.push_handlers(self)
         del self.on_end
+        self.updaters.append(updater)
         if start:
             updater.start(self)
         return updater
 
     def remove_updater(self, updater):
         self.remove_handlers(updater)
+        if updater in self.updaters:
+            self.updaters.remove(updater)
+        #the updater's final state still has to be drawn
+        self.changed = True
 
     def default_on_end(self, updater, target):
         self.remove_updater(updater)
 
     def add_world_object(self, obj):
         self.world_objects.append(obj)
+        self.changed = True
         return obj
 
     def remove_world_object(self, obj):
         self.world_objects.remove(obj)
+        self.changed = True
 
     def add_hud_object(self, obj):
         self.hud_objects.append(obj)
+        self.changed = True
         return obj
 
     def remove_hud_object(self, obj):
         self.hud_objects.remove(obj)
+        self.changed = True
 
     def add_light(self, light):
         self.lightSet.add_light(light)
@@ -99,19 +254,77 @@ class Scene(pyglet.event.EventDispatcher):
         self.lightSet.set_ambient(color)
 
 Scene.register_event_type('on_update')
+Scene.register_event_type('on_interpolate')
 
 
 class TextureScene(Scene):
     '''draws to a custom framebuffer instead of the active window. Allows anything to be drawn
         on pages that could be rendered in the game, for example'''
-    def __init__(self, camera, window, width, height, background):
+    def __init__(self, camera, window, width, height, background, pool=None):
+        '''
+        Parameters:
+            pool (None or framebuffer.FramebufferPool): if given, the framebuffer is borrowed
+                from the pool when first needed and may be taken back when the scene hasn't
+                been used for a while. Otherwise the scene allocates its own immediately
+        '''
         Scene.__init__(self, camera)
-        self.framebuffer = framebuffer.Framebuffer(width, height)
-        self.framebuffer.unbind(window)
+        self.pool = pool
+        if pool is None:
+            self.framebuffer = framebuffer.Framebuffer(width, height)
+            self.framebuffer.unbind(window)
+        else:
+            self.framebuffer = None
         self.window = window
         self.background = background
+        self.dirty = True
+        #resolution level requested from the pool: 0 for full size, each level halving it
+        self.level = 0
+
+    def invalidate(self):
+        '''mark the texture as stale. Call after changing an object already in the scene,
+        for example the text of a hud label'''
+        self.dirty = True
+
+    def add_world_object(self, obj):
+        self.dirty = True
+        return Scene.add_world_object(self, obj)
 
+    def remove_world_object(self, obj):
+        self.dirty = True
+        Scene.remove_world_object(self, obj)
+
+    def add_hud_object(self, obj):
+        self.dirty = True
+        return Scene.add_hud_object(self, obj)
+
+    def remove_hud_object(self, obj):
+        self.dirty = True
+        Scene.remove_hud_object(self, obj)
+
+    def needs_redraw(self):
+        return self.dirty
+
+    def get_framebuffer(self):
+        if self.pool is not None:
+            if self.framebuffer is None or self.framebuffer.level != self.level:
+                self.framebuffer = self.pool.acquire(self, self.level)
+                self.dirty = True
+            else:
+                self.pool.touch(self)
+        return self.framebuffer
+
+    def release_framebuffer(self):
+        '''called by the pool when the framebuffer is handed to another scene'''
+        self.framebuffer = None
+        self.dirty = True
+
+    @profiling.profiler.timed('TextureScene.draw')
     def draw(self):
+        '''renders to the framebuffer only if something changed since the last render'''
+        self.get_framebuffer()
+        if not self.dirty:
+            stats.counters.count('texture_redraws_skipped')
+            return
         self.framebuffer.bind()
         self.camera.hud_mode()
         self.background.draw()
@@ -124,9 +337,11 @@ class TextureScene(Scene):
         for obj in self.hud_objects:
             obj.draw()
         self.framebuffer.unbind(self.window)
+        self.dirty = False
+        stats.counters.count('texture_redraws')
 
     def get_texture(self):
-        return self.framebuffer.texture
+        return self.get_framebuffer().texture
 
     def __del__(self):
         del self.framebuffer
@@ -145,6 +360,7 @@ class Updater(pyglet.event.EventDispatcher):
         self.children = []
         self.active = False
         self.age = initial
+        self.previous_age = initial #age before the latest update
         self.next = None
         self.dead = False
         self.duration = duration
@@ -163,11 +379,16 @@ class Updater(pyglet.event.EventDispatcher):
         self.dispatch_event('on_end', self, self.target)
 
     def on_update(self, scene, dt):
+        self.previous_age = self.age
         if self.active:
             self.age += dt
         if self.duration is not None:
             if self.age > self.duration:
                 self.age = self.duration
 
+    def interpolated_age(self, alpha):
+        '''age between the previous and latest update, for drawing with a fixed-step Director'''
+        return self.previous_age + alpha*(self.age - self.previous_age)
+
 Updater.register_event_type('on_start')
 Updater.register_event_type('on_end')     
@@ -1,19 +1,42 @@
 from pyglet.gl import *
 import pyglet
+from collections import OrderedDict
 
 class Framebuffer(object):
     '''An OpenGL framebuffer object with an associated texture, since pyglet's built-in
     classes don't seem to have a method to bind them as the active framebuffer'''
-    def __init__(self, width, height):
+    def __init__(self, width, height, depth=False, internalformat=GL_RGBA, mipmap=False):
+        '''
+        Parameters:
+            width, height (int): size in pixels
+            depth (bool): attach a depth buffer, for scenes that need depth testing
+            internalformat (GLenum): format of the color texture, for example GL_RGBA32F
+                to read back exact float colors
+            mipmap (bool): filter the texture through mipmaps, regenerated by unbind after
+                each render, so it doesn't alias when drawn small or at a grazing angle
+        '''
         self.width = width
         self.height = height
+        self.mipmap = mipmap
         self.id = GLuint()
         glGenFramebuffers(1, self.id)
         glBindFramebuffer(GL_FRAMEBUFFER, self.id)
-        self.texture = pyglet.image.Texture.create(width, height, min_filter=GL_LINEAR,
-                                                   mag_filter=GL_LINEAR)
+        min_filter = GL_LINEAR_MIPMAP_LINEAR if mipmap else GL_LINEAR
+        self.texture = pyglet.image.Texture.create(width, height, internalformat,
+                                                   min_filter=min_filter, mag_filter=GL_LINEAR)
+        if mipmap:
+            #allocate the levels, or the texture is incomplete until the first render
+            self.generate_mipmaps()
         glFramebufferTexture(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
                                self.texture.id, 0)
+        self.depth_id = None
+        if depth:
+            self.depth_id = GLuint()
+            glGenRenderbuffers(1, self.depth_id)
+            glBindRenderbuffer(GL_RENDERBUFFER, self.depth_id)
+            glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER,
+                                      self.depth_id)
         
         draw_buffers = GLenum(GL_COLOR_ATTACHMENT0)
         glDrawBuffers(1, draw_buffers)
@@ -39,14 +62,144 @@ class Framebuffer(object):
     def bind(self):
         glBindFramebuffer(GL_FRAMEBUFFER, self.id)
         glViewport(0, 0, self.width, self.height)
-        glClear(GL_COLOR_BUFFER_BIT)
+        if self.depth_id is None:
+            glClear(GL_COLOR_BUFFER_BIT)
+        else:
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
     def unbind(self, window):
-        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        '''go back to drawing window's frame: into its render_target framebuffer if it has
+        one, as headless.py gives it, or else its own'''
+        target = getattr(window, 'render_target', None)
+        glBindFramebuffer(GL_FRAMEBUFFER, target.id if target is not None else 0)
         glViewport(0, 0, window.width, window.height)
+        if self.mipmap:
+            self.generate_mipmaps()
+
+    def generate_mipmaps(self):
+        glBindTexture(self.texture.target, self.texture.id)
+        glGenerateMipmap(self.texture.target)
+        glBindTexture(self.texture.target, 0)
 
     def __del__(self):
         del self.texture
         glDeleteFramebuffers(1, self.id)
-        glDeleteRenderbuffers(1, self.depth_id)
+        if self.depth_id is not None:
+            glDeleteRenderbuffers(1, self.depth_id)
+
+
+class FrameSnapshot(object):
+    '''Copy of the last frame drawn in a window, so it can be put back on screen when nothing
+    has changed. Capturing is a single glCopyTexSubImage2D and presenting a single textured
+    quad, both much cheaper than drawing the scene again.'''
+    def __init__(self, width, height):
+        self.resize(width, height)
+
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+        self.texture = pyglet.image.Texture.create(width, height, min_filter=GL_NEAREST,
+                                                   mag_filter=GL_NEAREST)
+        self.valid = False
+
+    def capture(self):
+        '''copy the frame just drawn, before the buffers are flipped'''
+        glBindTexture(self.texture.target, self.texture.id)
+        glCopyTexSubImage2D(self.texture.target, 0, 0, 0, 0, 0, self.width, self.height)
+        self.valid = True
+
+    def present(self):
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        gluOrtho2D(0, self.width, 0, self.height)
+        glMatrixMode(GL_MODELVIEW)
+        glLoadIdentity()
+        glDisable(GL_LIGHTING)
+        glDisable(GL_DEPTH_TEST)
+        glColor4f(1, 1, 1, 1)
+        #copy the captured pixels as they are. Blending would mix pixels captured with
+        #alpha below 1, such as page text, with the undefined back buffer
+        blend = glIsEnabled(GL_BLEND)
+        glDisable(GL_BLEND)
+        self.texture.blit(0, 0)
+        if blend:
+            glEnable(GL_BLEND)
+
+
+class FramebufferPool(object):
+    '''A bounded set of framebuffers shared by TextureScenes, at full size or at lower
+    resolution levels, each half the size of the one before. capacity is counted in full
+    size framebuffers, so a level 1 framebuffer takes a quarter of one. When the budget is
+    spent, spare framebuffers of other sizes are freed first, then the least recently used
+    owners give theirs up and have to re-render the next time they are needed. Owners must
+    have a release_framebuffer method.'''
+    def __init__(self, width, height, capacity, mipmap=False):
+        '''mipmap (bool): passed on to the framebuffers'''
+        self.width = width
+        self.height = height
+        self.capacity = capacity
+        self.mipmap = mipmap
+        self.owners = OrderedDict() #owner: framebuffer, least recently used first
+        self.spare = {} #level: framebuffers
+        self.used = 0.0 #full size framebuffers' worth allocated, owned or spare
+
+    def size(self, level):
+        return max(1, self.width >> level), max(1, self.height >> level)
+
+    def cost(self, level):
+        return 1.0/4**level
+
+    def acquire(self, owner, level=0):
+        '''
+        Returns: a framebuffer at resolution level for owner. A different framebuffer from
+            the one owner had, if it was taken back or was at another level, must be
+            rendered again
+        '''
+        if owner in self.owners:
+            buffer = self.owners.pop(owner)
+            if buffer.level == level:
+                self.owners[owner] = buffer
+                return buffer
+            self.spare.setdefault(buffer.level, []).append(buffer)
+        if not self.spare.get(level):
+            self.make_room(level)
+        if self.spare.get(level):
+            buffer = self.spare[level].pop()
+        else:
+            #creating a framebuffer binds it, so put back whatever was being drawn into
+            previous = GLint()
+            glGetIntegerv(GL_FRAMEBUFFER_BINDING, previous)
+            buffer = Framebuffer(*self.size(level), mipmap=self.mipmap)
+            glBindFramebuffer(GL_FRAMEBUFFER, previous.value)
+            buffer.level = level
+            self.used += self.cost(level)
+        self.owners[owner] = buffer
+        return buffer
+
+    def make_room(self, level):
+        '''free or take back framebuffers until one at level fits in the budget, stopping
+        early if one at level becomes spare'''
+        while self.used + self.cost(level) > self.capacity + 1e-9:
+            spare_levels = [other for other in self.spare if self.spare[other]]
+            if spare_levels:
+                other = spare_levels[0]
+                self.spare[other].pop()
+                self.used -= self.cost(other)
+            elif self.owners:
+                old_owner, buffer = self.owners.popitem(last=False)
+                old_owner.release_framebuffer()
+                self.spare.setdefault(buffer.level, []).append(buffer)
+                if buffer.level == level:
+                    return
+            else:
+                return
+
+    def touch(self, owner):
+        '''mark owner as most recently used'''
+        self.owners[owner] = self.owners.pop(owner)
 
+    def release(self, owner):
+        if owner in self.owners:
+            buffer = self.owners.pop(owner)
+            self.spare.setdefault(buffer.level, []).append(buffer)
+            owner.release_framebuffer()
@@ -2,7 +2,8 @@ import pyglet
 from pyglet.gl import *
 import numpy as np
 from math import sin, cos, sqrt, atan2, pi
-import random
+import ctypes
+import stats
 
 '''Sets up the framework for rendering 3D objects with pyglet, and provides utility to functions
 for generating curved meshes without needing to import them from WaveFront files. Also
@@ -17,26 +18,23 @@ def make_indices(width, height, CCW=True):
         CCW (bool): changes the sense of the indices to counter-clockwise
     Returns: list of int
     '''
-    indices = []
-    for x in range(width):
-        for y in range(height):
-            index0 = x*(height+1) + y
-            if not CCW:
-                index1 = index0 + 1
-                index2 = index0 + (height+1)
-            else:
-                index2 = index0 + 1
-                index1 = index0 + (height+1)
-            index3 = index0 + height + 2
-            if (x+y)%2:
-                indices.extend([index0, index1, index2])
-                indices.extend([index3, index2, index1])
-            else:
-                indices.extend([index0, index1, index3])
-                indices.extend([index0, index3, index2])
-    return indices
-
-def make_vertices(width, height, length, curve=None, bumpiness=(0, 0, .1)):
+    x, y = np.meshgrid(np.arange(width), np.arange(height), indexing='ij')
+    index0 = x*(height+1) + y
+    if not CCW:
+        index1 = index0 + 1
+        index2 = index0 + (height+1)
+    else:
+        index2 = index0 + 1
+        index1 = index0 + (height+1)
+    index3 = index0 + height + 2
+    #alternate the diagonal of each quad in a checkerboard
+    odd = ((x+y)%2 == 1)[..., np.newaxis]
+    indices = np.where(odd,
+                       np.stack([index0, index1, index2, index3, index2, index1], axis=-1),
+                       np.stack([index0, index1, index3, index0, index3, index2], axis=-1))
+    return indices.ravel().tolist()
+
+def make_vertices(width, height, length, curve=None, bumpiness=(0, 0, .1), seed=None):
     '''
     Generate the vertices and normals for a mesh
     Parameters:
@@ -44,24 +42,32 @@ def make_vertices(width, height, length, curve=None, bumpiness=(0, 0, .1)):
         length (float): length of mesh edges
         curve (None or instance of CurveX): specifies mesh shape
         bumpiness (tuple of 3 float): random deviation from curve in each direction
+        seed (None, int or np.random.RandomState): seed for the bumpiness
     Returns: (vertices, normals) (3D numpy arrays)
         Note: rows/first index corresponds to u values in the mesh, columns to v
     '''
-    vertices, normals, = [], []
-    for i in range(width+1):
-        for mylist in vertices, normals:
-            mylist.append([])
-        x, z, nx, nz = i*length, 0, 0, 1 
-        if isinstance(curve, CurveX):
-            x, z, nx, nz = curve(i*1.0/width)
-        elif curve is not None:
-            raise ValueError, "if not None, curve must be CurveX instance"
-        for j in range(height+1):
-            y, ny = j*length, 0
-            bump = [b *random.random()*length - .5 for b in bumpiness]
-            vertices[-1].append([x+bump[0], y+bump[1] , z+bump[2]])
-            normals[-1].append([nx, ny, nz])
-    return np.array(vertices), np.array(normals)
+    i = np.arange(width+1)
+    if isinstance(curve, CurveX):
+        positions, curve_normals = curve.evaluate(i*1.0/width)
+        x, z = positions.T
+        nx, nz = curve_normals.T
+    elif curve is not None:
+        raise ValueError, "if not None, curve must be CurveX instance"
+    else:
+        x, z, nx, nz = i*length, 0, 0, 1
+    if isinstance(seed, np.random.RandomState):
+        rng = seed
+    else:
+        rng = np.random.RandomState(seed)
+    vertices = np.empty((width+1, height+1, 3))
+    vertices[..., 0] = np.reshape(x, (-1, 1))
+    vertices[..., 1] = np.arange(height+1)*length
+    vertices[..., 2] = np.reshape(z, (-1, 1))
+    vertices += np.asarray(bumpiness)*rng.random_sample(vertices.shape)*length - .5
+    normals = np.zeros((width+1, height+1, 3))
+    normals[..., 0] = np.reshape(nx, (-1, 1))
+    normals[..., 2] = np.reshape(nz, (-1, 1))
+    return vertices, normals
 
 def make_tex_coords(vertices):
     '''Returns unstretched texture coordinates'''
@@ -87,25 +93,64 @@ def make_tex_coords(vertices):
 
 def make_solid_colors(width, height, color=[1.0, 1.0, 1.0, 1.0]):
     ''' Returns RGBA colors for the mesh'''
-    colors = []
-    for i in range(width+1):
-        colors.append([])
-        for j in range(height+1):
-           colors[-1].append(color)
-    return np.array(colors)
+    return np.tile(np.asarray(color, dtype=float), (width+1, height+1, 1))
+
+def make_leaf(curve, size, columns=11):
+    '''
+    A slab following a right-hand page's curve, for drawing a stack of pages as a few thick
+    leaves: the top surface plus the head, tail and fore-edge faces hanging below it. The
+    bottom of those faces is given a drop of 1, to be moved down by the slab's thickness
+    when drawn.
+    Parameters:
+        curve (CurveX): page shape, as in make_vertices
+        size (float): page width and height
+        columns (int): points along the curve
+    Returns: (vertices, normals, drops, indices) as float32 arrays of shape (n, 3), (n, 3)
+        and (n,), and a uint32 array of triangle indices
+    '''
+    positions, curve_normals = curve.evaluate(np.linspace(0, 1, columns))
+    x, z = positions.T
+    nx, nz = curve_normals.T
+    zero, one = np.zeros(columns), np.ones(columns)
+    strips = [] #(vertices, normals, drops) of strips two vertices wide, along the curve
+    def strip(y0, y1, drop0, drop1, normal):
+        vertices = np.dstack([np.column_stack((x, y0*one, z)), np.column_stack((x, y1*one, z))])
+        drops = np.column_stack((drop0*one, drop1*one))
+        strips.append((vertices.transpose(0, 2, 1), np.repeat(normal[:, np.newaxis], 2, 1),
+                       drops))
+    strip(0, size, 0, 0, np.column_stack((nx, zero, nz)))
+    strip(0, 0, 1, 0, np.tile([0.0, -1.0, 0.0], (columns, 1)))
+    strip(size, size, 0, 1, np.tile([0.0, 1.0, 0.0], (columns, 1)))
+    #the fore-edge, facing along the curve's tangent at the outer end
+    edge = np.array([[x[-1], 0, z[-1]], [x[-1], size, z[-1]]])
+    strips.append((np.array([edge, edge]), np.tile([nz[-1], 0.0, -nx[-1]], (2, 2, 1)),
+                   np.array([[1.0, 1.0], [0.0, 0.0]])))
+    vertices, normals, drops, indices = [], [], [], []
+    first = 0
+    for strip_vertices, strip_normals, strip_drops in strips:
+        length = len(strip_vertices)
+        for i in range(length - 1):
+            a, b = first + 2*i, first + 2*i + 2
+            indices.extend((a, b, a + 1, a + 1, b, b + 1))
+        vertices.append(strip_vertices.reshape(-1, 3))
+        normals.append(strip_normals.reshape(-1, 3))
+        drops.append(strip_drops.ravel())
+        first += 2*length
+    return (np.concatenate(vertices).astype(np.float32),
+            np.concatenate(normals).astype(np.float32),
+            np.concatenate(drops).astype(np.float32), np.array(indices, dtype=np.uint32))
 
 def make_coordinate_colors(width, height, green, right_side=True):
     '''Useful for mousepicking. Since green is uniform, it identifies which object was picked'''
-    colors = []
-    for i in range(width+1):
-        colors.append([])
-        if right_side:
-            u = i*1.0/width
-        else:
-            u = 1.0 - (i*1.0/width)
-        for j in range(height+1):
-            colors[-1].append([u, green, j*1.0/height, 1.0])
-    return np.array(colors)
+    u = np.arange(width+1)*1.0/width
+    if not right_side:
+        u = 1.0 - u
+    colors = np.empty((width+1, height+1, 4))
+    colors[..., 0] = u[:, np.newaxis]
+    colors[..., 1] = green
+    colors[..., 2] = np.arange(height+1)*1.0/height
+    colors[..., 3] = 1.0
+    return colors
 
 def _interpret_axis(axis):
     if axis == 'x':
@@ -160,6 +205,31 @@ def matrix_transform(vertices, matrix, inplace=False):
     else:
         return np.inner(vertices, matrix)
 
+def make_rotation_matrices(vector, angles):
+    '''
+    Batched make_rotation_matrix
+    Parameters:
+        vector (len 3 iterable): rotation axis, must be normalized
+        angles (iterable of float): one rotation per angle
+    Returns: (N, 3, 3) np array
+    '''
+    angles = np.asarray(angles, dtype=float)
+    c = np.cos(angles)
+    s = np.sin(angles)
+    t = 1 - c
+    x, y, z = vector[0], vector[1], vector[2]
+    matrices = np.empty(angles.shape + (3, 3))
+    matrices[..., 0, 0] = c + x**2*t
+    matrices[..., 0, 1] = x*y*t - z*s
+    matrices[..., 0, 2] = x*z*t + y*s
+    matrices[..., 1, 0] = y*x*t + z*s
+    matrices[..., 1, 1] = c + y**2*t
+    matrices[..., 1, 2] = y*z*t - x*s
+    matrices[..., 2, 0] = z*x*t - y*s
+    matrices[..., 2, 1] = z*y*t + x*s
+    matrices[..., 2, 2] = c + z**2*t
+    return matrices
+
 def flap(vertices, vector, angles, inplace=False):
     '''
     Allows rotation that is desynchronized (on the zero axis). Needed to turn pages
@@ -167,15 +237,96 @@ def flap(vertices, vector, angles, inplace=False):
         vertices (np.array), vector (len 3 iterable): as above
         angles (iterable): how much to rotate each row by. Length must match vertices.shape[0]
         '''
-    matrix = np.zeros((3, 3))
+    matrices = make_rotation_matrices(vector, angles)
+    #row i of the output is vertices[i] transformed by matrices[i], as np.inner would
+    out = np.matmul(vertices, matrices.swapaxes(-1, -2))
     if inplace:
-        v = vertices
+        vertices[:] = out
+        return vertices
+    return out
+
+def flap_pair(vertices, normals, vector, angles):
+    '''
+    flap for a whole mesh: vertices and normals are rotated with one set of matrices
+    and a single matmul
+    Parameters:
+        vertices, normals (3D np arrays of the same shape)
+        vector, angles: as in flap. angles may have extra leading dimensions, e.g.
+            (frames, rows), to flap several poses at once
+    Returns: (vertices, normals)
+    '''
+    matrices = make_rotation_matrices(vector, angles)
+    both = np.concatenate((vertices, normals), axis=-2)
+    both = np.matmul(both, matrices.swapaxes(-1, -2))
+    split = vertices.shape[-2]
+    return both[..., :split, :], both[..., split:, :]
+
+def ray_hits_boxes(lows, highs, origin, direction):
+    '''
+    Slab test of one ray against many axis-aligned boxes.
+    Parameters:
+        lows, highs (ndarray (..., 3)): box corners
+        origin, direction (array of 3 float): the ray
+    Returns: bool ndarray (...), True where the ray passes through the box in front of the origin
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse = 1.0/np.asarray(direction, float)
+        near = (lows - origin)*inverse
+        far = (highs - origin)*inverse
+    #fmin/fmax skip the nans from a ray lying exactly in a box face
+    enter = np.fmax.reduce(np.fmin(near, far), axis=-1)
+    leave = np.fmin.reduce(np.fmax(near, far), axis=-1)
+    return (enter <= leave) & (leave >= 0)
+
+def intersect_grid(vertices, origin, direction, margin=1e-3):
+    '''
+    Casts a ray at a grid mesh such as a page from make_vertices, splitting each cell into two
+    triangles. Columns of cells whose bounding boxes the ray misses are skipped.
+    Parameters:
+        vertices (ndarray (width+1, height+1, 3))
+        origin, direction (array of 3 float): the ray
+        margin (float): padding for the column bounding boxes, so flat pages aren't missed
+    Returns: None if the ray misses, otherwise (t, column, row): distance along the ray in
+        units of direction, and the grid position of the nearest hit, from 0 to width and
+        0 to height
+    '''
+    origin = np.asarray(origin, float)
+    direction = np.asarray(direction, float)
+    lows = np.minimum(vertices[:-1].min(axis=1), vertices[1:].min(axis=1)) - margin
+    highs = np.maximum(vertices[:-1].max(axis=1), vertices[1:].max(axis=1)) + margin
+    columns = np.nonzero(ray_hits_boxes(lows, highs, origin, direction))[0]
+    if not len(columns):
+        return None
+    #cell corners, counterclockwise from (column, row). Triangles are abc and acd
+    a = vertices[columns, :-1]
+    b = vertices[columns+1, :-1]
+    c = vertices[columns+1, 1:]
+    d = vertices[columns, 1:]
+    first = np.array([a, a])
+    edge1 = np.array([b, c]) - first
+    edge2 = np.array([c, d]) - first
+    #Moller-Trumbore, for all candidate triangles at once
+    p = np.cross(direction, edge2)
+    determinant = (edge1*p).sum(axis=-1)
+    valid = np.abs(determinant) > 1e-12
+    inverse = 1.0/np.where(valid, determinant, 1.0)
+    offset = origin - first
+    bu = (offset*p).sum(axis=-1)*inverse
+    q = np.cross(offset, edge1)
+    bv = (q*direction).sum(axis=-1)*inverse
+    t = (q*edge2).sum(axis=-1)*inverse
+    #a little slack so rays through shared edges and corners are not lost to rounding
+    hit = valid & (bu >= -1e-9) & (bv >= -1e-9) & (bu + bv <= 1 + 1e-9) & (t > 0)
+    if not hit.any():
+        return None
+    t = np.where(hit, t, np.inf)
+    triangle, band, row = np.unravel_index(np.argmin(t), t.shape)
+    u, v = bu[triangle, band, row], bv[triangle, band, row]
+    if triangle == 0:
+        dx, dy = u + v, v
     else:
-        v = np.copy(vertices)
-    for i, angle in enumerate(angles):
-        matrix[:] = make_rotation_matrix(vector, angle)
-        matrix_transform(v[i], matrix, inplace=True)
-    return v
+        dx, dy = u, u + v
+    return (float(t[triangle, band, row]), columns[band] + dx, row + dy)
 
 def get_flap_angles(width, curve):
     '''
@@ -184,11 +335,27 @@ def get_flap_angles(width, curve):
         width (int): number of edges in zero axis
         curve(CurveX): geometry of initial conformation. Must be in the positive quadrant
     '''
-    angles = []
-    for i in range(width+1):
-        x, z, nx, nz = curve(i*1.0/width)
-        angles.append( pi - 2*atan2(z, x) )
-    return np.array(angles)
+    positions, normals = curve.evaluate(np.arange(width+1)*1.0/width)
+    return pi - 2*np.arctan2(positions[:, 1], positions[:, 0])
+
+def binomial_coefficients(n):
+    '''row n of Pascal's triangle'''
+    row = [1]
+    for k in range(n):
+        row.append(row[-1]*(n - k)//(k + 1))
+    return np.array(row, dtype=float)
+
+def bernstein_basis(s, degree):
+    '''
+    Bernstein polynomials of a degree evaluated at each s
+    Parameters:
+        s (1D np array): points along the curve, from 0 to 1
+        degree (int)
+    Returns: (len(s), degree+1) np array. Multiplying by the control points gives the curve
+    '''
+    s = np.asarray(s, dtype=float)[:, np.newaxis]
+    k = np.arange(degree+1)
+    return binomial_coefficients(degree)*s**k*(1-s)**(degree - k)
 
 def bezier5curve(s, points):
     '''
@@ -199,35 +366,76 @@ def bezier5curve(s, points):
     returns:
         [x, z, nx, nz]: location and norm of curve at that point
     '''
-    prefactors = [1, 4, 6, 4, 1]
-    out = [0, 0, 0, 0]
-    for i, v in enumerate(prefactors):
-        p = v * s**i * (1-s)**(4-i)
-        for j in range(2):
-            out[j] += p*points[i][j]
-    normal_prefactors = [
-        -4*(1-s)**3,
-        4*(1-s)**3 - 12*s*(1-s)**2,
-        12*s*(1-s)*(1- 2* s),
-        12*s**2*(1-s) - 4*s**3,
-        4*s**3
-        ]
-    ratio = sum([normal_prefactors[i]*points[i][1] for i in range(5)])*1.0/sum([
-        normal_prefactors[i]*points[i][0] for i in range(5)])
-    out[3] = (1+ratio**2)**(-.5)
-    out[2] = -ratio*out[3]
-    return out
+    return BezierCurve(points)(s)
 
 
 class CurveX(object):
+    '''A curve in the xz plane, parametrized by s from 0 to 1'''
     def __init__(self):
         pass
 
     def __call__(self, x):
+        '''returns [x, z, nx, nz] at a single point'''
         raise NotImplementedError, "Abstract class - subclass to use"
 
+    def evaluate(self, s):
+        '''
+        Evaluate the curve at many points. Subclasses should override this with something
+        faster than calling the curve once per point
+        Parameters:
+            s (1D np array)
+        Returns: (positions, normals) as (len(s), 2) np arrays of x, z and nx, nz
+        '''
+        out = np.array([self(value) for value in s], dtype=float).reshape(-1, 4)
+        return out[:, :2], out[:, 2:]
+
 
-class PageCurve(CurveX):
+class BezierCurve(CurveX):
+    '''Bezier curve of any degree, evaluated for whole arrays of s at once'''
+    def __init__(self, points):
+        '''points (list of n+1 tuples of 2 float): control points of a degree n curve'''
+        self.points = np.array(points, dtype=float)
+        self.degree = len(self.points) - 1
+        #control points of the derivative, a degree n-1 curve
+        self.derivative_points = self.degree*np.diff(self.points, axis=0)
+        self.bases = {}
+
+    def basis(self, s):
+        '''Bernstein bases for the curve and its derivative. Precomputed bases are kept for
+        each evenly spaced sampling, so remeshing at a resolution already used is a single
+        matrix product'''
+        count = len(s)
+        key = (count, s[0], s[-1])
+        if key in self.bases and np.array_equal(self.bases[key][0], s):
+            return self.bases[key][1:]
+        bases = (bernstein_basis(s, self.degree), bernstein_basis(s, self.degree - 1))
+        if count > 1 and np.allclose(np.diff(s), (s[-1] - s[0])/(count - 1)):
+            self.bases[key] = (np.array(s),) + bases
+        return bases
+
+    def evaluate(self, s):
+        s = np.atleast_1d(np.asarray(s, dtype=float))
+        basis, derivative_basis = self.basis(s)
+        positions = basis.dot(self.points)
+        tangents = derivative_basis.dot(self.derivative_points)
+        #rotate the tangent a quarter turn so the normal always has positive z
+        sign = np.where(tangents[:, 0] < 0, -1.0, 1.0)
+        normals = np.empty_like(tangents)
+        normals[:, 0] = -sign*tangents[:, 1]
+        normals[:, 1] = sign*tangents[:, 0]
+        normals /= np.sqrt(np.sum(np.square(tangents), axis=1))[:, np.newaxis]
+        return positions, normals
+
+    def __call__(self, s):
+        '''[x, z, nx, nz] at s. If s is an array each entry is an array too'''
+        positions, normals = self.evaluate(s)
+        out = [positions[:, 0], positions[:, 1], normals[:, 0], normals[:, 1]]
+        if np.ndim(s) == 0:
+            return [float(value[0]) for value in out]
+        return out
+
+
+class PageCurve(BezierCurve):
     '''curve for a right-facing page'''
     def __init__(self, size):
         points = [
@@ -237,61 +445,189 @@ class PageCurve(CurveX):
             (.3*size, .12*size),
             (size, .06*size)
             ]
-        def call(s): return bezier5curve(s, points)
-        self.func = call
-
-    def __call__(self, s):
-        return self.func(s)
+        BezierCurve.__init__(self, points)
 
  
+class MeshStateGroup(pyglet.graphics.Group):
+    '''GL state shared by all lit, textured meshes. Used as the parent group when several
+    meshes are drawn from one shared batch, so the state is set once per batch draw rather
+    than once per mesh'''
+    def set_state(self):
+        glEnable(GL_NORMALIZE)
+        glEnable(GL_CULL_FACE)
+        glCullFace(GL_BACK)
+        glEnable(GL_DEPTH_TEST)
+        stats.counters.count('state_changes')
+
+    def unset_state(self):
+        glDisable(GL_NORMALIZE)
+        glDisable(GL_CULL_FACE)
+
+
+class MeshTextureGroup(pyglet.graphics.Group):
+    '''Binds a mesh's texture. Unlike pyglet's TextureGroup it compares by identity rather
+    than by texture, so the texture can be swapped without moving the vertex list to another
+    group'''
+    def __init__(self, texture, parent=None):
+        pyglet.graphics.Group.__init__(self, parent)
+        self.texture = texture
+
+    def set_state(self):
+        glEnable(self.texture.target)
+        glBindTexture(self.texture.target, self.texture.id)
+        #every mesh has its own group, so each group is drawn with one call
+        stats.counters.count('state_changes')
+        stats.counters.count('draw_calls')
+
+    def unset_state(self):
+        glDisable(self.texture.target)
+
+
 class Mesh(object):
-    def __init__(self, indices, vertices, normals, tex_coords, colors, texture):
+    def __init__(self, indices, vertices, normals, tex_coords, colors, texture, batch=None,
+                 parent=None, column_attribute=None):
         '''
         parameters:
-            indices (list of int): corners for each triangle in the mesh
+            indices (list or 1D np array of int): corners for each triangle in the mesh
             vertices (3D np array): vertex positions
             normals (3D np array): normals at each vertex
             tex_coords (3D np array): each vertice's position in the background texture
             colors (3D np array): 
             texture (pyglet.graphics.Texture): texture for mesh.
+            batch (None or pyglet.graphics.Batch): shared batch to add the mesh to. By default
+                the mesh gets a batch of its own. Meshes in a shared batch are drawn by
+                drawing the batch, not with Mesh.draw
+            parent (None or pyglet.graphics.Group): parent of the mesh's texture group,
+                normally a MeshStateGroup when the batch is shared
+            column_attribute (None or int): generic attribute index to fill with each vertex's
+                column (index along the first axis), for shaders that deform a mesh column by
+                column
         '''
+        if isinstance(indices, np.ndarray):
+            indices = indices.tolist()
         self.vertices = vertices
         self.normals = normals
         self.colors = colors
+        self.indices = indices
         self.int_width, self.int_height = vertices.shape[0], vertices.shape[1]
         self.texture = texture
-        self.group = pyglet.graphics.TextureGroup(self.texture)
-        self.batch = pyglet.graphics.Batch()
+        self.group = MeshTextureGroup(self.texture, parent)
+        self.shared = batch is not None
+        if batch is None:
+            batch = pyglet.graphics.Batch()
+        self.batch = batch
+        self.visible = True
+        #positions and normals change every frame of a turn, so each gets a buffer of its own
+        #and only they are uploaded. Texture coordinates and colors are interleaved in one
+        #static buffer
+        formats = ['v3f/dynamic', 'n3f/dynamic', 't2f/static', 'c4f/static']
+        if column_attribute is not None:
+            #pyglet lists static attributes twice, which it rejects for generic ones
+            formats.append('%ig1f/dynamic' %column_attribute)
         self.vertex_list = self.batch.add_indexed(
             (np.prod([i for i in vertices.shape[:-1]])), GL_TRIANGLES, self.group, indices,
-            ('v3f', np.ravel(vertices)),
-            ('n3f', np.ravel(normals)),
-            ('t2f', np.ravel(tex_coords)),
-            ('c4f', np.ravel(colors))
-             )
-                                
+            *formats)
+        self.write('vertices', vertices)
+        self.write('normals', normals)
+        self.write('tex_coords', tex_coords)
+        self.write('colors', colors)
+        if column_attribute is not None:
+            columns = np.arange(vertices.shape[0], dtype=float)
+            self.write(column_attribute, np.repeat(columns, vertices.shape[1]))
+
+    def attribute_array(self, name, first=0, stop=None):
+        '''
+        Writable float32 view of one attribute for vertices first to stop of this mesh, lying
+        directly on the vertex buffer's client-side copy. The buffer moves when the batch
+        grows, so get a new view for every write rather than keeping one.
+        Parameters:
+            name (str or int): 'vertices', 'normals', 'tex_coords', 'colors' or the index of a
+                generic attribute
+        Returns: (view with shape (stop - first, components), buffer region). Call the region's
+            invalidate method after writing to have the change uploaded on the next draw
+        '''
+        names = self.vertex_list.domain.attribute_names
+        if isinstance(name, int):
+            attribute = names['generic'][name]
+        else:
+            attribute = names[name]
+        if stop is None:
+            stop = self.vertex_list.count
+        start = (self.vertex_list.start + first)*attribute.stride
+        size = (stop - first)*attribute.stride
+        region = attribute.buffer.get_region(start, size, ctypes.POINTER(ctypes.c_byte*size))
+        floats = np.ctypeslib.as_array(region.array).view(np.float32)
+        offset = attribute.offset//4
+        view = floats.reshape(stop - first, attribute.stride//4)[:, offset:offset+attribute.count]
+        return view, region
+
+    def write(self, name, data, columns=None):
+        '''
+        Copies data for one attribute straight into the vertex buffer as float32.
+        Parameters:
+            name (str): as in attribute_array
+            data (array): values for every vertex, shaped like the mesh's vertices
+            columns (None or (start, stop)): range along the first axis of data that changed.
+                Only that part of the buffer is rewritten and uploaded
+        '''
+        data = np.asarray(data)
+        start, stop = columns or (0, len(data))
+        #vertices per step along the first axis
+        step = self.vertex_list.count//len(data)
+        view, region = self.attribute_array(name, start*step, stop*step)
+        view[...] = data[start:stop].reshape(view.shape)
+        region.invalidate()
+
     def draw(self):
         glEnable(GL_NORMALIZE)
         glEnable(GL_CULL_FACE)
         glCullFace(GL_BACK)
         glEnable(GL_DEPTH_TEST)
+        stats.counters.count('state_changes')
         self.batch.draw()
         glDisable(GL_NORMALIZE)
         glDisable(GL_CULL_FACE)
 
-    def update_normals(self, normals=None):
+    def update_normals(self, normals=None, columns=None):
+        '''columns (None or (start, stop)): only these columns changed, as in write'''
         if not normals is None:
             assert all([self.normals.shape[i]==normals.shape[i] for i in range(3)]
                        ), "Invalid shape for new normals"
             self.normals = normals
-        self.vertex_list.normals = np.ravel(self.normals)
+        self.write('normals', self.normals, columns)
         
-    def update_vertices(self, vertices=None):
+    def update_vertices(self, vertices=None, columns=None):
+        '''columns (None or (start, stop)): only these columns changed, as in write'''
         if not vertices is None:
             assert all([self.vertices.shape[i]==vertices.shape[i] for i in range(3)]
                    ), "Invalid shape for new vertices"
             self.vertices = vertices
-        self.vertex_list.vertices = np.ravel(self.vertices)
+        self.write('vertices', self.vertices, columns)
+
+    def update_tex_coords(self, tex_coords):
+        self.write('tex_coords', tex_coords)
+
+    def update_indices(self, indices):
+        self.indices = indices
+        if self.visible:
+            start = self.vertex_list.start
+            self.vertex_list.indices = [index + start for index in indices]
+
+    def set_visible(self, visible):
+        '''show or hide a mesh in a shared batch. Hidden meshes keep their vertex list but
+        all their triangles are collapsed onto one vertex, so nothing is rasterized'''
+        if visible == self.visible:
+            return
+        self.visible = visible
+        start = self.vertex_list.start
+        if visible:
+            self.vertex_list.indices = [index + start for index in self.indices]
+        else:
+            self.vertex_list.indices = [start]*len(self.indices)
+
+    def set_texture(self, texture):
+        self.texture = texture
+        self.group.texture = texture
 
     def reverse_normals(self):
         self.normals = -self.normals
@@ -0,0 +1,268 @@
+'''Renders the book without a visible window, for generating previews in bulk on machines
+with no display. Frames are drawn into a framebuffer object on a surfaceless EGL context where
+Mesa provides one, so no X server is needed, or else on a hidden window. Time advances by a
+fixed step per frame rather than by the wall clock, so the output is the same however fast
+the machine is, and page turns are scripted instead of clicked. Frames can be written as
+numbered PNGs or as one raw RGBA stream, for example
+    python headless.py --flips 3 --out preview --format raw
+    ffmpeg -f rawvideo -pix_fmt rgba -s 1200x600 -r 30 -i preview/frames.rgba -vf vflip out.mp4
+'''
+import pyglet
+#the shadow window needs a display. SurfacelessContext stands in for it where there is none
+pyglet.options['shadow_window'] = False
+from pyglet.gl import *
+import pyglet.window
+import argparse
+import ctypes
+import ctypes.util
+import os
+import time
+import framebuffer
+import stats
+import profiling
+import main as book_setup
+
+
+class EGLError(Exception):
+    pass
+
+
+class SurfacelessContext(pyglet.gl.Context):
+    '''An OpenGL context with no window or X server, from Mesa's surfaceless EGL platform.
+    pyglet 1.2 has no EGL support, so it is made through ctypes. There is no default
+    framebuffer: everything has to be drawn into framebuffer objects'''
+    EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+    EGL_OPENGL_API = 0x30A2
+
+    def __init__(self, canvas):
+        '''canvas: what the context draws for. pyglet only checks one is attached before
+        making a context current'''
+        pyglet.gl.Context.__init__(self, None)
+        name = ctypes.util.find_library('EGL')
+        if name is None:
+            raise EGLError, "libEGL not found"
+        egl = self.egl = ctypes.CDLL(name)
+        egl.eglGetProcAddress.restype = ctypes.c_void_p
+        egl.eglGetProcAddress.argtypes = [ctypes.c_char_p]
+        egl.eglInitialize.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int),
+                                      ctypes.POINTER(ctypes.c_int)]
+        egl.eglBindAPI.argtypes = [ctypes.c_uint]
+        egl.eglCreateContext.restype = ctypes.c_void_p
+        egl.eglCreateContext.argtypes = [ctypes.c_void_p]*3 + [ctypes.POINTER(ctypes.c_int)]
+        egl.eglMakeCurrent.argtypes = [ctypes.c_void_p]*4
+        egl.eglDestroyContext.argtypes = [ctypes.c_void_p]*2
+        egl.eglTerminate.argtypes = [ctypes.c_void_p]
+        address = egl.eglGetProcAddress('eglGetPlatformDisplayEXT')
+        if not address:
+            raise EGLError, "eglGetPlatformDisplayEXT unavailable"
+        get_platform_display = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_uint,
+                                                ctypes.c_void_p, ctypes.c_void_p)(address)
+        self.display = get_platform_display(self.EGL_PLATFORM_SURFACELESS_MESA, None, None)
+        major, minor = ctypes.c_int(), ctypes.c_int()
+        if not self.display or not egl.eglInitialize(self.display, major, minor):
+            raise EGLError, "no surfaceless EGL display"
+        #no config: the context is never drawn to through an EGL surface
+        if not egl.eglBindAPI(self.EGL_OPENGL_API):
+            raise EGLError, "EGL has no desktop OpenGL"
+        self.egl_context = egl.eglCreateContext(self.display, None, None, None)
+        if not self.egl_context:
+            egl.eglTerminate(self.display)
+            raise EGLError, "eglCreateContext failed"
+        self.canvas = canvas
+
+    def set_current(self):
+        if not self.egl.eglMakeCurrent(self.display, None, None, self.egl_context):
+            raise EGLError, "eglMakeCurrent failed"
+        pyglet.gl.Context.set_current(self)
+
+    def destroy(self):
+        pyglet.gl.Context.destroy(self)
+        self.egl.eglMakeCurrent(self.display, None, None, None)
+        self.egl.eglDestroyContext(self.display, self.egl_context)
+        self.egl.eglTerminate(self.display)
+
+
+class OffscreenWindow(pyglet.event.EventDispatcher):
+    '''Stands in for a hidden pyglet Window on a SurfacelessContext, with the size, events
+    and methods the book and this script use'''
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.context = SurfacelessContext(self)
+        self.context.set_current()
+
+    def switch_to(self):
+        self.context.set_current()
+
+    def clear(self):
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+    def close(self):
+        self.context.destroy()
+
+OffscreenWindow.event_types = list(pyglet.window.BaseWindow.event_types)
+
+
+def open_window(width, height):
+    '''
+    Returns: an OffscreenWindow, or a hidden pyglet Window where there is no surfaceless
+        EGL, which needs a display. Either has a render_target framebuffer to draw frames
+        into and read them back from, since a hidden window's own has undefined contents
+    '''
+    try:
+        window = OffscreenWindow(width, height)
+    except EGLError:
+        window = pyglet.window.Window(width, height, visible=False)
+    window.render_target = framebuffer.Framebuffer(width, height, depth=True)
+    return window
+
+
+class FrameRecorder(object):
+    '''reads finished frames back from the framebuffer they were drawn into and writes them
+    to disk'''
+    def __init__(self, width, height, directory, format='png'):
+        '''
+        Parameters:
+            width, height (int): frame size
+            directory (str): created if it doesn't exist
+            format (str): 'png' for one numbered file per frame, 'raw' for a single
+                frames.rgba file of bottom-up RGBA rows, frame after frame
+        '''
+        if format not in ('png', 'raw'):
+            raise ValueError, "unknown frame format %r" %format
+        self.width = width
+        self.height = height
+        self.directory = directory
+        self.format = format
+        self.pixels = (GLubyte * (width*height*4))()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.stream = None
+        if format == 'raw':
+            self.stream = open(os.path.join(directory, 'frames.rgba'), 'wb')
+        self.frames = 0
+
+    def capture(self, target):
+        '''target (framebuffer.Framebuffer): holding the frame'''
+        glBindFramebuffer(GL_FRAMEBUFFER, target.id)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE, self.pixels)
+        if self.stream is not None:
+            self.stream.write(buffer(self.pixels))
+        else:
+            image = pyglet.image.ImageData(self.width, self.height, 'RGBA', self.pixels)
+            image.save(os.path.join(self.directory, 'frame%05i.png' %self.frames))
+        self.frames += 1
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+class FlipScript(object):
+    '''turns the book forward a set number of times, pausing between turns'''
+    def __init__(self, book, flips, pause):
+        '''
+        Parameters:
+            flips (int): number of page turns
+            pause (int): frames to wait before each turn
+        '''
+        self.book = book
+        self.flips = flips
+        self.pause = pause
+        self.wait = pause
+
+    def wait_for_content(self):
+        '''block until the content workers have prepared every requested page, so frames
+        don't depend on how fast they are'''
+        if self.book.content is not None:
+            self.book.content.join()
+
+    def done(self):
+        return self.flips <= 0 and not self.book.folio.flipping
+
+    def step(self):
+        if self.book.folio.flipping or self.flips <= 0:
+            return
+        if self.wait > 0:
+            self.wait -= 1
+            return
+        if self.book.current >= len(self.book.source) - 3:
+            self.flips = 0
+            return
+        self.book.flip_right(self.book.scenes[self.book.current + 2])
+        #the flip slides the book's window onto new pages, whose text is requested then
+        self.wait_for_content()
+        self.flips -= 1
+        self.wait = self.pause
+
+
+def render(window, director, script, fps=30, max_frames=None, recorder=None):
+    '''
+    Draws frames at a fixed timestep until the script is done.
+    Parameters:
+        window: from open_window
+        director: from main.create_book
+        script (FlipScript)
+        fps (float): simulated frame rate. Each frame advances time by 1/fps
+        max_frames (None or int): stop early after this many frames
+        recorder (None or FrameRecorder): saves each frame
+    Returns: (frames drawn, wall clock seconds spent)
+    '''
+    dt = 1.0/fps
+    frames = 0
+    start = time.time()
+    while not script.done() and (max_frames is None or frames < max_frames):
+        script.step()
+        director.update(dt)
+        window.switch_to()
+        #clears it too
+        window.render_target.bind()
+        director.draw()
+        if recorder is not None:
+            recorder.capture(window.render_target)
+        frames += 1
+    glFinish()
+    return frames, time.time() - start
+
+
+def run():
+    parser = argparse.ArgumentParser(description='render page turns without a display')
+    parser.add_argument('--width', type=int, default=1200)
+    parser.add_argument('--height', type=int, default=600)
+    parser.add_argument('--pages', type=int, default=20)
+    parser.add_argument('--flips', type=int, default=1, help='page turns to render')
+    parser.add_argument('--pause', type=int, default=15, help='frames between turns')
+    parser.add_argument('--fps', type=float, default=30, help='simulated frame rate')
+    parser.add_argument('--max-frames', type=int, default=None)
+    parser.add_argument('--out', default=None, help='directory for frames. Nothing is '
+                        'written if omitted, which measures rendering alone')
+    parser.add_argument('--format', choices=['png', 'raw'], default='png')
+    parser.add_argument('--gpu-curl', action='store_true', help='turn pages in a shader')
+    parser.add_argument('--profile', default=None, metavar='TRACE.json',
+                        help='time the hot paths and save a chrome trace here')
+    args = parser.parse_args()
+    profiling.profiler.enabled = bool(args.profile)
+
+    window = open_window(args.width, args.height)
+    director, book = book_setup.create_book(window, args.pages, args.gpu_curl)
+    recorder = None
+    if args.out:
+        recorder = FrameRecorder(args.width, args.height, args.out, args.format)
+    script = FlipScript(book, args.flips, args.pause)
+    script.wait_for_content()
+    frames, seconds = render(window, director, script, args.fps, args.max_frames, recorder)
+    if recorder is not None:
+        recorder.close()
+    print '%i frames in %.2f s: %.1f frames per second' %(
+        frames, seconds, frames/max(seconds, 1e-9))
+    for name in sorted(stats.counters.totals):
+        print '    %s: %.1f per frame' %(name, stats.counters.average(name))
+    if args.profile:
+        print profiling.profiler.report()
+        profiling.profiler.export_chrome_trace(args.profile)
+    window.close()
+
+if __name__ == '__main__':
+    run()
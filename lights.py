@@ -65,6 +65,7 @@ class LightSet:
             glLightfv(gl_light, GL_SPOT_CUTOFF, GLfloat(90))
             glLightfv(gl_light, GL_SPOT_EXPONENT, GLfloat(.5))
         self.external_lights = [] #(pointer to light, glLight)
+        self.drawn_state = None #state() when last drawn
         
     def draw(self):
         glEnable(GL_LIGHT0)
@@ -74,6 +75,17 @@ class LightSet:
             glLightfv(gl_light, GL_POSITION, light.position)
             glLightfv(gl_light, GL_DIFFUSE, light.color)
             glLightfv(gl_light, GL_SPOT_DIRECTION, light.direction)
+        self.drawn_state = self.state()
+
+    def state(self):
+        '''every value the lights are drawn with'''
+        return (tuple(self.masterLight.color),
+                tuple([(gl_light, tuple(light.position), tuple(light.color),
+                        tuple(light.direction)) for light, gl_light in self.external_lights]))
+
+    def changed(self):
+        '''whether any light was added, removed, moved or recolored since the last draw'''
+        return self.state() != self.drawn_state
 
     def set_ambient(self, color):
         self.masterLight.set_color(color)
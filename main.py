@@ -1,31 +1,56 @@
 import pyglet
 import director as dr
 import page
+import pagesource
 from camera import Camera
+from content import ContentPipeline
 import lights
+import profiling
+import os
 
 
-def main():
-    config = pyglet.gl.Config(sample_buffers=1, samples=4)
-    window  = pyglet.window.Window(1200, 600, config=config)
+def create_book(window, npages=20, gpu_curl=False, fixed_step=None):
+    '''
+    Sets up the camera, lighting and a book of random pages for a window.
+    fixed_step is passed to the Director.
+    Returns: (director, book), with the book already started as the active scene
+    '''
     camera = Camera(
         [0, 200, 1200],
         [0, page.Page.size/2, 0],
         aspect=window.width*1.0/window.height,
         field_of_view=30, width=window.width, height=window.height)
-    director = dr.Director()
-    book = page.Book(camera, window, 20)
-    for scene in book.scenes:
-        scene.add_hud_object(page.create_random_page())
+    director = dr.Director(fixed_step)
+    source = pagesource.GeneratorSource(npages)
+    #page text is written on worker threads, so long books open without a pause
+    book = page.Book(camera, window, source, shared_batch=True, gpu_curl=gpu_curl,
+                     content=ContentPipeline(source.text), mipmap=True, levels=3,
+                     page_stack=True)
     light = book.add_light(lights.CandleLight([250, 350, 800], .9))
     book.set_ambient([.05, .07, .08])
     director.start_scene(book)
+    return director, book
+
+
+def main():
+    config = pyglet.gl.Config(sample_buffers=1, samples=4)
+    window  = pyglet.window.Window(1200, 600, config=config)
+    director, book = create_book(window, fixed_step=1.0/60)
+    #BOOK_PROFILE=1 shows frame timings; BOOK_PROFILE=trace.json also saves a chrome trace
+    profile = os.environ.get('BOOK_PROFILE')
+    if profile:
+        profiling.profiler.enabled = True
+        book.add_hud_object(profiling.ProfilerOverlay(profiling.profiler))
+    #redraw only after input or while something moves, otherwise re-present the last frame
+    director.watch(window)
     @window.event
     def on_draw():
-        window.clear()
-        director.draw()
-    pyglet.clock.schedule_interval(director.update, 1.0/60)
+        director.present(window)
+    director.schedule(window, render_cap=60, vsync=True)
     pyglet.app.run()
+    if profile and profile.endswith('.json'):
+        profiling.profiler.export_chrome_trace(profile)
+        print profiling.profiler.report()
 
 if __name__ == '__main__':
     main()
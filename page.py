@@ -1,22 +1,98 @@
 import director as dr
 import geometry
 import framebuffer
+import assets
+import shaders
+import profiling
+import stats
+import pagetext
+import pagesource
 import pyglet
 from pyglet.gl import *
 import camera
 import lights
 from loremipsum import get_paragraphs
 from wave_parser import WaveParser
-import os
+import numpy as np
+from collections import OrderedDict
+import ctypes
+import warnings
 
 '''All the logic associated with the book simulation itself'''
 
-pyglet.font.add_file(os.getcwd() + '/fonts/Summerti.ttf')
-summer = pyglet.font.load('Summerti')
+
+class TurnKeyframes(object):
+    '''Precomputed page-turn poses. A turn only depends on which side the page starts on,
+    whether it is face up and which way it turns, so each configuration is flapped once at
+    evenly spaced progress values and turners interpolate between the stored frames.'''
+    def __init__(self, frames=60, max_bytes=32*2**20):
+        '''
+        Parameters:
+            frames (int): poses stored per configuration, including both ends of the turn
+            max_bytes (int): memory cap for all configurations. Least recently used
+                configurations are dropped first, and frames is reduced if a single
+                configuration would not fit
+        '''
+        self.frames = frames
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.configurations = OrderedDict()
+
+    def frame_count(self):
+        frame_bytes = 2*3*np.dtype(np.float32).itemsize*(Page.width+1)*(Page.height+1)
+        return max(2, min(self.frames, self.max_bytes//frame_bytes))
+
+    def compute(self, right_side, face_up, angles):
+        vertices, normals = Page.base_pose(right_side, face_up)
+        progress = np.linspace(0, 1, self.frame_count())
+        vertices, normals = geometry.flap_pair(
+            vertices, normals, PageTurner.vector, np.outer(progress, angles))
+        frames = (np.ascontiguousarray(vertices, dtype=np.float32),
+                  np.ascontiguousarray(normals, dtype=np.float32))
+        for array in frames:
+            array.flags.writeable = False #meshes keep references to the frames
+        return frames
+
+    def get(self, right_side, face_up, right_to_left, angles):
+        '''
+        Returns: (vertices, normals) frames for a configuration, computing them if needed
+            angles (np array): flap angles of a full turn. Only used on a cache miss, so
+                they must be the same every time for a given right_to_left
+        '''
+        key = (right_side, face_up, right_to_left)
+        if key in self.configurations:
+            frames = self.configurations.pop(key)
+        else:
+            frames = self.compute(right_side, face_up, angles)
+            self.nbytes += sum([array.nbytes for array in frames])
+            while self.configurations and self.nbytes > self.max_bytes:
+                old_key, old_frames = self.configurations.popitem(last=False)
+                self.nbytes -= sum([array.nbytes for array in old_frames])
+        self.configurations[key] = frames
+        return frames
+
+    def pose(self, right_side, face_up, right_to_left, angles, progress):
+        '''(vertices, normals) at progress (0 to 1) through the turn, linearly interpolated'''
+        vertices, normals = self.get(right_side, face_up, right_to_left, angles)
+        position = min(max(progress, 0.0), 1.0)*(len(vertices) - 1)
+        i = min(int(position), len(vertices) - 2)
+        weight = position - i
+        if weight == 0:
+            return vertices[i], normals[i]
+        elif weight == 1:
+            return vertices[i+1], normals[i+1]
+        return (vertices[i] + weight*(vertices[i+1] - vertices[i]),
+                normals[i] + weight*(normals[i+1] - normals[i]))
+
+    def clear(self):
+        self.configurations.clear()
+        self.nbytes = 0
 
 
 class PageTurner(dr.Updater):
     vector = [0, 1, 0]
+    #shared by all turners; set to None to flap the page geometry exactly on every update
+    keyframes = TurnKeyframes()
     
     def __init__(self, target, initial, duration, right_to_left=True):
         '''
@@ -32,31 +108,39 @@ class PageTurner(dr.Updater):
 
     def on_update(self, manager, dt, targets=[]):
         dr.Updater.on_update(self, manager, dt)
+        if not getattr(manager, 'interpolated', False):
+            #otherwise the pose is set once per drawn frame, in on_interpolate
+            self.pose(self.age, targets)
+        if self.duration is not None:
+            if self.age == self.duration:
+                self.end()
+
+    def on_interpolate(self, manager, alpha, targets=[]):
+        self.pose(self.interpolated_age(alpha), targets)
+
+    def pose(self, age, targets=[]):
+        '''bend the target pages as they are at age into the turn'''
         if len(targets) == 0:
             targets = [self.target]
-        if self.age < 0:
+        if age < 0:
             return
+        progress = age*1.0/self.duration
         for target in targets:
-            angles = self.age*1.0/self.duration*self.angles
-            if  target.right_side:
-                vertices = Page.right_vertices
-                if target.face_up:
-                    normals = Page.right_top_normals
-                else:
-                    normals = Page.right_bottom_normals
+            if target.curl is not None:
+                #the vertex shader flaps the resident rest pose
+                target.curl.set_angles(self.angles)
+                target.curl.progress = progress
+                continue
+            if self.keyframes is None:
+                vertices, normals = Page.base_pose(target.right_side, target.face_up)
+                vertices, normals = geometry.flap_pair(
+                    vertices, normals, self.vector, progress*self.angles)
             else:
-                vertices = Page.left_vertices
-                if target.face_up:
-                    normals = Page.left_top_normals
-                else:
-                    normals = Page.left_bottom_normals
-            vertices = geometry.flap(vertices, self.vector, angles)
-            normals = geometry.flap(normals, self.vector, angles)
+                vertices, normals = self.keyframes.pose(
+                    target.right_side, target.face_up, self.right_to_left, self.angles,
+                    progress)
             target.mesh.update_vertices(vertices)
             target.mesh.update_normals(normals)
-        if self.duration is not None:
-            if self.age == self.duration:
-                self.end()
 
 
 class FolioTurner(dr.Updater):
@@ -76,7 +160,7 @@ class FolioTurner(dr.Updater):
         self.target.flipping = True
 
     def on_update(self, manager, dt):
-        self.child.on_update(self, dt, self.child_targets)
+        self.child.on_update(manager, dt, self.child_targets)
         dr.Updater.on_update(self, manager, dt)
         if not self.halfway and self.age > .5*self.duration:
             self.halfway = True
@@ -84,22 +168,29 @@ class FolioTurner(dr.Updater):
         if self.child.dead:
             self.end()
 
+    def on_interpolate(self, manager, alpha):
+        self.child.on_interpolate(manager, alpha, self.child_targets)
+
     def end(self):
         for target in self.child_targets:
             target.face_up = not target.face_up
             target.right_side = not target.right_side
             target.set_mesh()
-        (self.target.bottom_right, self.target.middle_right,
-                self.target.bottom_left, self.target.middle_left) = (None, None, None, None)
+        self.target.clear_hidden()
         self.target.flipping = False
         dr.Updater.end(self)     
 
 
 class BlenderObject(object):
     '''convert an externally created WaveFront object into an OpenGL renderable mesh'''
-    def __init__(self):
+    def __init__(self, batch=None, parent=None, skip=()):
+        '''
+        Parameters:
+            batch, parent: optional shared batch and parent group, as in geometry.Mesh
+            skip (iterable): keys of texture_names whose parts aren't drawn
+        '''
         parser = WaveParser()
-        parser.parse(open(self.object_name))
+        parser.load(self.object_name)
         vertices = self.size*parser.vertices
         normals = parser.normals
         indices = parser.indices.items()[0][1]
@@ -108,10 +199,12 @@ class BlenderObject(object):
         geometry.translate(vertices, self.origin_shift, inplace=True)
         self.meshes = []
         for key in self.texture_names:
-            texture = pyglet.image.load(self.texture_names[key]).texture
+            if key in skip:
+                continue
+            texture = assets.cache.texture(self.texture_names[key])
             self.meshes.append(geometry.Mesh(
                 parser.indices[key], vertices, normals, tex_coords,
-                                  colors, texture)
+                                  colors, texture, batch, parent)
                                )
 
     def draw(self):
@@ -129,7 +222,111 @@ class BookCover(BlenderObject):
                             }
     origin_shift = [2, 2, -30]
 
-    
+
+class PageStack(object):
+    '''The pages under the open spread, drawn as a few thick leaves that each stand for many
+    pages, left and right in one instanced draw call whatever the length of the book. The
+    leaves' mirroring, depth and thickness are per-instance attributes, rewritten only when
+    the number of pages on either side changes. Needs shaders.instancing_supported'''
+    color = (.92, .86, .72, 1.0)
+
+    def __init__(self, program, npages, depth=20.0, max_leaves=32, pages_per_leaf=8, gap=None,
+                 columns=11):
+        '''
+        Parameters:
+            program (shaders.ShaderProgram): from shaders.page_stack_program
+            npages (int): pages in the book
+            depth (float): thickness of all the book's pages together, in world units
+            max_leaves (int): most leaves per side. Longer books put more pages in each
+                leaf, so the cost of drawing stays the same
+            pages_per_leaf (int): fewest pages a leaf stands for
+            gap (None or float): space between the open pages' curve and the first leaf, so
+                they don't fight over depth. Defaults to clearing the pages' deepest bump
+            columns (int): points along the page curve in the leaf mesh
+        '''
+        self.program = program
+        self.max_leaves = max_leaves
+        self.per_leaf = max(pages_per_leaf, -(-npages//max_leaves))
+        self.thickness = depth*self.per_leaf/max(npages, 1)
+        if gap is None:
+            #and a quarter unit more, so depth precision doesn't bring the bumps back
+            gap = Page.bump_depth + .25
+        self.gap = gap
+        vertices, normals, drops, indices = geometry.make_leaf(Page.curve, Page.size, columns)
+        self.index_count = len(indices)
+        #vertices, normals, drops, indices and instances
+        self.buffers = (GLuint * 5)()
+        glGenBuffers(5, self.buffers)
+        targets = [GL_ARRAY_BUFFER]*3 + [GL_ELEMENT_ARRAY_BUFFER]
+        for buffer, target, data in zip(self.buffers, targets,
+                                        (vertices, normals, drops, indices)):
+            glBindBuffer(target, buffer)
+            glBufferData(target, data.nbytes, data.ctypes.data, GL_STATIC_DRAW)
+        self.instances = np.zeros((2*max_leaves, 4), dtype=np.float32)
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffers[4])
+        glBufferData(GL_ARRAY_BUFFER, self.instances.nbytes, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        self.leaves = 0
+        self.counts = None
+
+    def set_counts(self, left, right):
+        '''number of pages under the left and right sides of the open spread'''
+        if (left, right) == self.counts:
+            return
+        self.counts = (left, right)
+        rows = []
+        for side, pages in ((-1.0, left), (1.0, right)):
+            for leaf in range(min(self.max_leaves, -(-pages//self.per_leaf))):
+                #alternate the shade so the leaves read as layers at the edges
+                rows.append((side, self.gap + leaf*self.thickness, self.thickness,
+                             1.0 - .06*(leaf % 2)))
+        self.leaves = len(rows)
+        if rows:
+            self.instances[:self.leaves] = rows
+            glBindBuffer(GL_ARRAY_BUFFER, self.buffers[4])
+            glBufferSubData(GL_ARRAY_BUFFER, 0, self.leaves*self.instances.strides[0],
+                            self.instances.ctypes.data)
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def draw(self):
+        if not self.leaves:
+            return
+        self.program.bind()
+        self.program.set_vector('page_color', self.color)
+        glEnable(GL_DEPTH_TEST)
+        #the left leaves are mirrored, which reverses their winding
+        glDisable(GL_CULL_FACE)
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffers[0])
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glVertexPointer(3, GL_FLOAT, 0, None)
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffers[1])
+        glEnableClientState(GL_NORMAL_ARRAY)
+        glNormalPointer(GL_FLOAT, 0, None)
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffers[2])
+        glEnableVertexAttribArray(shaders.DROP_ATTRIBUTE)
+        glVertexAttribPointer(shaders.DROP_ATTRIBUTE, 1, GL_FLOAT, GL_FALSE, 0, None)
+        glBindBuffer(GL_ARRAY_BUFFER, self.buffers[4])
+        glEnableVertexAttribArray(shaders.INSTANCE_ATTRIBUTE)
+        glVertexAttribPointer(shaders.INSTANCE_ATTRIBUTE, 4, GL_FLOAT, GL_FALSE, 0, None)
+        glVertexAttribDivisor(shaders.INSTANCE_ATTRIBUTE, 1)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.buffers[3])
+        glDrawElementsInstanced(GL_TRIANGLES, self.index_count, GL_UNSIGNED_INT, None,
+                                self.leaves)
+        glVertexAttribDivisor(shaders.INSTANCE_ATTRIBUTE, 0)
+        glDisableVertexAttribArray(shaders.INSTANCE_ATTRIBUTE)
+        glDisableVertexAttribArray(shaders.DROP_ATTRIBUTE)
+        glDisableClientState(GL_NORMAL_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.program.unbind()
+        stats.counters.count('draw_calls')
+
+    def __del__(self):
+        glDeleteBuffers(5, self.buffers)
+
+
 class Page(object):
     '''should only be added as a world_object to avoid messing up cameras'''
     background_name = 'parchment.png'
@@ -137,7 +334,14 @@ class Page(object):
     width, height = 50, 50
     length = size/width
     curve = geometry.PageCurve(size)
-    right_vertices, right_top_normals = geometry.make_vertices(width, height, length, curve)
+    bumpiness = (0, 0, .1)
+    #fixed, so every run and every page shows the same paper
+    bumpiness_seed = 0
+    right_vertices, right_top_normals = geometry.make_vertices(width, height, length, curve,
+                                                               bumpiness, bumpiness_seed)
+    #how far the bumps reach below the curve, which PageStack's leaves have to stay under
+    bump_depth = float(np.max(curve.evaluate(np.arange(width + 1)*1.0/width)[0][:, 1:]
+                              - right_vertices[..., 2]))
     left_vertices = geometry.flip(right_vertices, axis='x')
     right_bottom_normals = geometry.reverse(right_top_normals)
     left_top_normals = geometry.flip(right_top_normals, 'x')
@@ -154,12 +358,17 @@ class Page(object):
     top_indices = geometry.make_indices(width, height, CCW=True)
     bottom_indices = geometry.make_indices(width, height, CCW=False)
     
-    def __init__(self, mcamera, window, scene, face_up, right_side):
+    def __init__(self, mcamera, window, scene, face_up, right_side, batch=None, parent=None,
+                 program=None):
         '''
         Parameters:
             camera, window: camera and pyglet.window.Window instances
             face_up (bool): page is initially face_up
             right_side (bool): whether page is initially to the left or right of the opening
+            batch, parent: optional shared batch and parent group, as in geometry.Mesh. Pages
+                in a shared batch are drawn with the batch, not with Page.draw
+            program (None or shaders.ShaderProgram): page curl program. If given, turns
+                are applied by the vertex shader instead of rewriting the vertices
         '''
         self.camera = mcamera
         self.face_up = face_up
@@ -171,15 +380,70 @@ class Page(object):
         vertices = self.choose_vertices()
         tex_coords = self.choose_tex_coords()
         normals = self.choose_normals()
+        self.curl = None
+        column_attribute = None
+        if program is not None:
+            self.curl = shaders.CurlGroup(program, self.width + 1, parent)
+            parent = self.curl
+            column_attribute = shaders.COLUMN_ATTRIBUTE
         self.mesh = geometry.Mesh(indices, vertices, normals, tex_coords, self.colors,
-                                  self.texture)
+                                  self.texture, batch, parent, column_attribute)
+
+    @classmethod
+    def base_pose(cls, right_side, face_up):
+        '''(vertices, normals) of an unturned page'''
+        if right_side:
+            vertices = cls.right_vertices
+            if face_up:
+                normals = cls.right_top_normals
+            else:
+                normals = cls.right_bottom_normals
+        else:
+            vertices = cls.left_vertices
+            if face_up:
+                normals = cls.left_top_normals
+            else:
+                normals = cls.left_bottom_normals
+        return vertices, normals
 
     def set_mesh(self):
+        if self.curl is not None:
+            self.curl.progress = 0.0
         vertices = self.choose_vertices()
         self.mesh.update_vertices(vertices)
         normals = self.choose_normals()
         self.mesh.update_normals(normals)
 
+    def rebind(self, scene, face_up, right_side):
+        '''reuse the existing mesh for another scene and orientation'''
+        top_right = (face_up == right_side)
+        if top_right != self.top_right:
+            self.top_right = top_right
+            self.mesh.update_indices(self.choose_indices())
+            self.mesh.update_tex_coords(self.choose_tex_coords())
+        self.face_up = face_up
+        self.right_side = right_side
+        self.set_mesh()
+        self.flat_scene = scene
+        self.texture = self.flat_scene.get_texture()
+        self.mesh.set_texture(self.texture)
+
+    def projected_size(self, step=10):
+        '''square root of the page's area on screen in window pixels, measured on every
+        step-th vertex in each direction'''
+        points = self.camera.project(self.current_vertices()[::step, ::step])
+        diagonal = points[1:, 1:] - points[:-1, :-1]
+        other = points[1:, :-1] - points[:-1, 1:]
+        area = .5*np.abs(diagonal[..., 0]*other[..., 1] - diagonal[..., 1]*other[..., 0]).sum()
+        return np.sqrt(area)
+
+    def current_vertices(self):
+        '''vertex positions as drawn, including any turn applied by the curl shader'''
+        if self.curl is None or self.curl.progress == 0:
+            return self.mesh.vertices
+        angles = self.curl.progress*np.array(self.curl.angles)
+        return geometry.flap(self.mesh.vertices, PageTurner.vector, angles)
+
     def choose_indices(self):
         if self.top_right:
             return self.top_indices
@@ -211,8 +475,14 @@ class Page(object):
             return self.right_bottom_tex_coords
 
     def set_texture(self):
+        texture = self.flat_scene.get_texture()
+        if texture is not self.texture:
+            #the scene's framebuffer was recycled while it was out of view
+            self.texture = texture
+            self.mesh.set_texture(texture)
         self.flat_scene.draw()
 
+    @profiling.profiler.timed('Page.draw')
     def draw(self):
         self.camera.focus()
         pyglet.gl.glEnable(pyglet.gl.GL_LIGHTING)
@@ -225,33 +495,82 @@ class Page(object):
         del self.texture
 
 
+class PagePool(object):
+    '''A fixed set of Page meshes that are rebound to new scenes instead of being rebuilt, so
+    turning a page doesn't allocate meshes, batches or vertex lists'''
+    def __init__(self, mcamera, window, scene, size=6, batch=None, parent=None, program=None):
+        '''
+        Parameters:
+            mcamera, window: as in Page
+            scene (TextureScene): placeholder contents for the pages until they are acquired
+            size (int): pages to create up front. A Folio shows at most six at once
+            batch, parent: optional shared batch and parent group for the pages. Free pages
+                in a shared batch are hidden so they don't get drawn
+            program: optional page curl program, as in Page
+        '''
+        self.camera = mcamera
+        self.window = window
+        self.batch = batch
+        self.parent = parent
+        self.program = program
+        self.free = []
+        for i in range(size):
+            self.release(self.create(scene, True, True))
+
+    def create(self, scene, face_up, right_side):
+        return Page(self.camera, self.window, scene, face_up, right_side, self.batch,
+                    self.parent, self.program)
+
+    def acquire(self, scene, face_up, right_side):
+        if not self.free:
+            return self.create(scene, face_up, right_side)
+        page = self.free.pop()
+        page.rebind(scene, face_up, right_side)
+        if self.batch is not None:
+            page.mesh.set_visible(True)
+        return page
+
+    def release(self, page):
+        if page is not None:
+            if self.batch is not None:
+                page.mesh.set_visible(False)
+            self.free.append(page)
+
+
 class Folio(dr.Scene):
     '''Next level up from Page, manages the collection of pages currently being shown to the user'''
-    def __init__(self, camera, window, scenes):
+    def __init__(self, camera, window, scenes, pool):
         dr.Scene.__init__(self, camera)
+        self.pool = pool
         self.bottom_left = None
         self.middle_left = None
-        self.top_left = Page(camera, window, scenes[0], True, False)
+        self.top_left = pool.acquire(scenes[0], True, False)
         self.bottom_right = None
         self.middle_right = None
-        self.top_right = Page(camera, window, scenes[1], True, True)
+        self.top_right = pool.acquire(scenes[1], True, True)
         self.flipping = False
 
+    def pages(self):
+        '''pages currently shown, bottom to top'''
+        return [page for page in (self.bottom_left, self.bottom_right, self.middle_left,
+                                  self.middle_right, self.top_left, self.top_right)
+                if page is not None]
+
+    @profiling.profiler.timed('Folio.set_textures')
     def set_textures(self):
-        for page in [self.bottom_left, self.bottom_right, self.middle_left, self.middle_right,
-                     self.top_left, self.top_right]:
-            try:
-                page.set_texture()
-            except AttributeError:
-                pass
+        for page in self.pages():
+            page.set_texture()
 
     def draw(self):
-        for page in [self.bottom_left, self.bottom_right, self.middle_left, self.middle_right,
-                     self.top_left, self.top_right]:
-            try:
-                page.draw()
-            except AttributeError:
-                pass
+        for page in self.pages():
+            page.draw()
+
+    def clear_hidden(self):
+        '''return the pages covered up by a finished turn to the pool'''
+        for page in (self.bottom_right, self.middle_right, self.bottom_left, self.middle_left):
+            self.pool.release(page)
+        (self.bottom_right, self.middle_right,
+                self.bottom_left, self.middle_left) = (None, None, None, None)
 
     def on_half_turned(self, updater, target, right_to_left):
         if right_to_left:
@@ -280,81 +599,260 @@ Folio.register_event_type('on_empty_right')
 Folio.register_event_type('on_empty_left')
 
 
+def texture_level(current, projected, full, levels, margin=.2):
+    '''
+    Resolution level for a page texture, the smallest at least projected pixels across.
+    A texture only drops to a lower level once projected is margin below that level's size,
+    so a page hovering near a boundary isn't rendered again every frame.
+    Parameters:
+        current (int): level the texture has now
+        projected (float): size of the page on screen, in pixels
+        full (int): size of the texture at level 0
+        levels (int): number of levels
+    '''
+    level = 0
+    while level < levels - 1 and projected <= full >> (level + 1):
+        level += 1
+    if level > current and projected > (full >> (current + 1))*(1 - margin):
+        return current
+    return level
+
+
 class Book(dr.Scene):
     '''Combines management of Folio with managing the contents of pages not
     currently shown and decorative background objects.'''
-    def __init__(self, mcamera, window, npages, starting=0):
+    #RayPicker or PagePicker, constructed with (camera, window, folio). Set below the pickers
+    picker_class = None
+
+    def __init__(self, mcamera, window, source, starting=0, shared_batch=False, lookahead=2,
+                 hover_pick=False, gpu_curl=False, content=None, mipmap=False, levels=1,
+                 page_stack=False):
         '''
         Parameters:
             mcamera, window (camera and window instances)
-            npages (int): number of dummy pages to start with
+            source (pagesource.PageSource or int): the pages. An int makes that many pages
+                of lorem ipsum
             starting (int): which page to open with
+            shared_batch (bool): put the cover and all folio pages in one batch, drawn with
+                a single camera setup, instead of drawing each mesh separately
+            lookahead (int): pages on either side of the open spread that keep a rendered
+                texture. Page textures further away are recycled and re-rendered on demand
+            hover_pick (bool): also pick on mouse motion, reported as 'on_pick' events with
+                the tag 'hover'
+            gpu_curl (bool): turn pages in a vertex shader. Falls back to turning them on
+                the CPU if the shader can't be compiled
+            content (None or content.ContentPipeline): if given, prepares the text of
+                pages in the background, nearest the open spread first, from the
+                pipeline's own generate function. Pages show blank parchment until their
+                text arrives
+            mipmap (bool): mipmap page textures, so pages seen small or edge on don't alias
+            levels (int): resolution levels for page textures, each half the size of the
+                last. Shown pages render at the level matching their size on screen, so
+                only the open spread gets full resolution. 1 renders everything full size
+            page_stack (bool): draw the pages on either side of the spread as a PageStack
+                that follows the reading position, instead of the cover's fixed block.
+                Falls back to the fixed block without instanced drawing
         '''
+        if isinstance(source, int):
+            source = pagesource.GeneratorSource(source)
+        self.source = source
         self.current = starting #current left page
+        self.lookahead = lookahead
+        self.hover_pick = hover_pick
+        self.levels = levels
         dr.Scene.__init__(self, mcamera)
         self.window = window
         self.background = pyglet.sprite.Sprite(
-            pyglet.image.load(Page.background_name))
+            assets.cache.image(Page.background_name))
         self.simple_camera = camera.SimpleCamera(
             self.background.width, self.background.height)
-        self.scenes = [dr.TextureScene(
-            self.simple_camera,
-            window,
-            self.background.width, self.background.height,
-            self.background)
-                       for i in range(npages)]
-        self.pick = PagePicker(self.camera, self.window)
-        self.cover = self.add_world_object(BookCover())
-        self.folio = Folio(mcamera, window, self.scenes[self.current:self.current+2])
-        self.add_world_object(self.folio)
+        #the open spread plus a turning leaf show at most four pages
+        self.framebuffers = framebuffer.FramebufferPool(
+            self.background.width, self.background.height, 4 + 2*lookahead, mipmap)
+        self.content = content
+        if content is not None:
+            content.start()
+            content.focus(self.current)
+        #only pages near the open spread exist as scenes, whatever the length of the book
+        self.scenes = pagesource.SceneCache(len(source), self.create_scene, self.drop_scene,
+                                            lookahead + 2)
+        self.scenes.slide(self.current)
+        program = None
+        if gpu_curl:
+            try:
+                program = shaders.page_curl_program(Page.width + 1)
+            except shaders.UNAVAILABLE, error:
+                warnings.warn('page curl shader unavailable, turning pages on the CPU: %s'
+                              %error, RuntimeWarning)
+        self.stack = None
+        if page_stack:
+            try:
+                if not shaders.instancing_supported():
+                    raise shaders.ShaderError, "instanced drawing needs OpenGL 3.3"
+                self.stack = PageStack(shaders.page_stack_program(), len(source))
+            except shaders.UNAVAILABLE, error:
+                warnings.warn('page stack unavailable, drawing a fixed block of pages: %s'
+                              %error, RuntimeWarning)
+        skip = ('pages',) if self.stack is not None else ()
+        if shared_batch:
+            self.batch = pyglet.graphics.Batch()
+            mesh_state = geometry.MeshStateGroup()
+            self.cover = BookCover(self.batch, mesh_state, skip)
+            self.page_pool = PagePool(mcamera, window, self.scenes[self.current],
+                                      batch=self.batch, parent=mesh_state, program=program)
+        else:
+            self.cover = self.add_world_object(BookCover(skip=skip))
+            self.page_pool = PagePool(mcamera, window, self.scenes[self.current],
+                                      program=program)
+        self.folio = Folio(mcamera, window, [self.scenes[self.current],
+                                             self.scenes[self.current + 1]], self.page_pool)
+        if self.stack is not None:
+            self.add_world_object(self.stack)
+            self.update_stack()
+        if not shared_batch:
+            self.add_world_object(self.folio)
+        self.picker = self.picker_class(self.camera, self.window, self.folio)
         self.window.push_handlers(self)
 
+    def create_scene(self, number):
+        scene = dr.TextureScene(self.simple_camera, self.window, self.background.width,
+                                self.background.height, self.background, self.framebuffers)
+        scene.number = number
+        #set while the content pipeline prepares the page, so stale results are ignored
+        scene.awaiting_content = self.content is not None and self.source.is_text(number)
+        if scene.awaiting_content:
+            self.content.request([number])
+        else:
+            contents = self.source.page(number)
+            if contents is not None:
+                scene.add_hud_object(contents)
+        return scene
+
+    def drop_scene(self, scene):
+        '''free what a scene leaving the cache holds on the GPU'''
+        self.framebuffers.release(scene)
+        for obj in scene.hud_objects:
+            if hasattr(obj, 'delete'):
+                obj.delete()
+        if self.content is not None:
+            self.content.cancel([scene.number])
+
+    def nearby(self):
+        '''scenes of the open spread and the lookahead pages on either side'''
+        first = max(0, self.current - self.lookahead)
+        last = min(len(self.source), self.current + 2 + self.lookahead)
+        return [self.scenes[number] for number in range(first, last)]
+
     def draw(self):
+        self.collect_content()
+        for x, y, tag, (side, u, v) in self.picker.update():
+            self.dispatch_event('on_pick', side, u, v, tag)
+        if self.levels > 1:
+            self.choose_levels()
         self.folio.set_textures()
+        self.prefetch()
         dr.Scene.draw(self)
 
+    def collect_content(self):
+        '''add page text finished by the content pipeline to its page'''
+        if self.content is None:
+            return
+        for number, text in self.content.collect():
+            if number in self.scenes and self.scenes[number].awaiting_content:
+                self.scenes[number].awaiting_content = False
+                if text is not None:
+                    self.scenes[number].add_hud_object(text)
+
+    def needs_redraw(self):
+        '''also true while a pick waits for a frame, page text has arrived, or a shown or
+        nearby page texture is stale'''
+        if dr.Scene.needs_redraw(self) or self.picker.pending():
+            return True
+        if self.content is not None and self.content.ready():
+            return True
+        for page in self.folio.pages():
+            if page.flat_scene.dirty:
+                return True
+        for scene in self.nearby():
+            if scene.dirty:
+                return True
+        return False
+
+    def update_stack(self):
+        self.stack.set_counts(self.current, max(0, len(self.source) - self.current - 2))
+
+    def choose_levels(self):
+        '''match the resolution of the shown pages' textures to their size on screen'''
+        for page in self.folio.pages():
+            page.flat_scene.level = texture_level(page.flat_scene.level, page.projected_size(),
+                                                  self.background.width, self.levels)
+
+    def prefetch(self):
+        '''render at most one stale page near the open spread per frame, so turning to it
+        doesn't stall'''
+        for scene in self.nearby():
+            if scene.dirty:
+                scene.draw()
+                return
+
     def flip_right(self, new_scene):
         '''new_scene: scene that will take up the new left page'''
         self.set_to(new_scene)
-        self.folio.middle_right = Page(
-                self.camera, self.window, self.scenes[self.current], False, True)
-        self.folio.bottom_right = Page(
-                self.camera, self.window, self.scenes[self.current+1], True, True)
+        self.folio.middle_right = self.page_pool.acquire(self.scenes[self.current], False, True)
+        self.folio.bottom_right = self.page_pool.acquire(self.scenes[self.current+1], True, True)
         self.add_updater(FolioTurner(self.folio, 0, 1.5, True))
 
     def flip_left(self, new_scene):
         self.set_to(new_scene)
-        self.folio.middle_left = Page(
-                self.camera, self.window, self.scenes[self.current], False, False)
-        self.folio.bottom_left = Page(
-                self.camera, self.window, self.scenes[self.current+1], True, False)
+        self.folio.middle_left = self.page_pool.acquire(self.scenes[self.current], False, False)
+        self.folio.bottom_left = self.page_pool.acquire(self.scenes[self.current+1], True, False)
         self.add_updater(FolioTurner(self.folio, 0, 1.5, False))
 
     def set_to(self, new_scene):
+        '''new_scene: page number, or scene from self.scenes, of the new left page'''
         if isinstance(new_scene, int):
             self.current = new_scene
         else:
-            self.current  = self.scenes.index(new_scene)
+            self.current = new_scene.number
+        if self.content is not None:
+            self.content.focus(self.current)
+        if self.stack is not None:
+            self.update_stack()
+        self.scenes.slide(self.current)
 
     def on_mouse_press(self, x, y, button, mods):
         if self.folio.flipping:
             return
-        side, u, v = self.pick(x, y)
-        if side == 'right' and u > .8 and self.current < len(self.scenes) - 3:
+        self.picker.request(x, y, 'press')
+
+    def on_mouse_motion(self, x, y, dx, dy):
+        if self.hover_pick:
+            self.picker.request(x, y, 'hover', hover=True)
+
+    def on_pick(self, side, u, v, tag):
+        '''default handler for finished picks, which arrive a frame after the mouse event.
+        Handlers pushed onto the book run first and can return True to stop the page turn'''
+        if tag != 'press' or self.folio.flipping:
+            return
+        if side == 'right' and u > .8 and self.current < len(self.source) - 3:
             self.flip_right(self.scenes[self.current + 2])
         elif side == 'left' and u < .2 and self.current > 1:
             self.flip_left(self.scenes[self.current - 2])
+Book.register_event_type('on_pick')
 
 class PagePicker(object):
-    '''uses pixel color to translate a click into UV coordinates in the page'''
-    def __init__(self, camera, window):
+    '''uses pixel color to translate a click into UV coordinates in the page. Picks render
+    the window pixel under the cursor into a 1x1 float framebuffer, so the visible frame is
+    untouched. request() reads the pixel back through a pixel buffer object and collects it
+    in the next frame's update(), so the GPU is never stalled waiting for the result.'''
+    def __init__(self, camera, window, folio=None):
+        '''folio is accepted for compatibility with RayPicker. Only pages at rest are picked'''
         self.camera = camera
         self.window = window
-        self.read_out = (GLfloat * 3)(0, 0, 0)
+        self.read_out = (GLfloat * 4)(0, 0, 0, 0)
         right_colors = geometry.make_coordinate_colors(Page.width, Page.height, 1.0, True)
         left_colors = geometry.make_coordinate_colors(Page.width, Page.height, .5, False)
-        texture = pyglet.image.SolidColorImagePattern((255, 255, 255, 255)
-                                                      ).create_image(1024, 1024).texture
+        texture = assets.cache.solid_texture(1024, 1024, (255, 255, 255, 255))
         self.right_mesh = geometry.Mesh(
             Page.top_indices, Page.right_vertices, Page.right_top_normals,
             Page.right_top_tex_coords, right_colors, texture
@@ -363,18 +861,27 @@ class PagePicker(object):
             Page.bottom_indices, Page.left_vertices, Page.left_top_normals,
             Page.right_bottom_tex_coords, left_colors, texture
             )
-
-    def draw(self):
-        self.window.clear()
-        self.camera.focus()
-        pyglet.gl.glDisable(pyglet.gl.GL_LIGHTING)
+        self.framebuffer = framebuffer.Framebuffer(1, 1, depth=True, internalformat=GL_RGBA32F)
+        self.framebuffer.unbind(window)
+        self.pixel_buffer = GLuint()
+        glGenBuffers(1, self.pixel_buffer)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pixel_buffer)
+        glBufferData(GL_PIXEL_PACK_BUFFER, ctypes.sizeof(self.read_out), None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.clicks = [] #(x, y, tag), all answered in order
+        self.hover = None #only the latest (x, y, tag) is kept
+        self.in_flight = None #request whose pixel is being read back
+
+    def draw(self, x, y):
+        '''render the pixel at (x, y) into the picking framebuffer, leaving it bound'''
+        self.framebuffer.bind()
+        self.camera.pick_focus(x, y)
+        glDisable(GL_LIGHTING)
         self.right_mesh.draw()
         self.left_mesh.draw()
 
-    def __call__(self, x, y):
-        self.draw()
-        glReadPixels(x, y, 1, 1, GL_RGB, GL_FLOAT, self.read_out)
-        u, green, v = tuple([v for v in self.read_out])
+    def decode(self):
+        u, green, v, alpha = tuple([v for v in self.read_out])
         if green > .75:
             side = 'right'
         elif green > .25:
@@ -383,10 +890,123 @@ class PagePicker(object):
             side = None
         return (side, u, v)
 
+    @profiling.profiler.timed('PagePicker.__call__')
+    def __call__(self, x, y):
+        '''pick immediately, waiting for the GPU. Returns (side, u, v)'''
+        self.draw(x, y)
+        glReadPixels(0, 0, 1, 1, GL_RGBA, GL_FLOAT, self.read_out)
+        self.framebuffer.unbind(self.window)
+        return self.decode()
+
+    def request(self, x, y, tag=None, hover=False):
+        '''
+        Queue a pick, answered by a later update().
+        Parameters:
+            x, y (int): window coordinates
+            tag: passed back with the result
+            hover (bool): replaces any hover pick not yet started instead of queueing, so
+                mouse motion never builds up a backlog
+        '''
+        if hover:
+            self.hover = (x, y, tag)
+        else:
+            self.clicks.append((x, y, tag))
+
+    def pending(self):
+        '''whether update still has picks to answer'''
+        return bool(self.clicks) or self.hover is not None or self.in_flight is not None
+
+    @profiling.profiler.timed('PagePicker.update')
+    def update(self):
+        '''
+        Call once per frame. Collects the pick started last frame and starts the next one.
+        Returns: list of (x, y, tag, (side, u, v)) for picks that finished
+        '''
+        results = []
+        if self.in_flight is not None:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pixel_buffer)
+            pointer = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+            if pointer:
+                ctypes.memmove(self.read_out, pointer, ctypes.sizeof(self.read_out))
+                glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+                x, y, tag = self.in_flight
+                results.append((x, y, tag, self.decode()))
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+            self.in_flight = None
+        if self.clicks:
+            self.in_flight = self.clicks.pop(0)
+        elif self.hover is not None:
+            self.in_flight, self.hover = self.hover, None
+        if self.in_flight is not None:
+            self.draw(*self.in_flight[:2])
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pixel_buffer)
+            glReadPixels(0, 0, 1, 1, GL_RGBA, GL_FLOAT, None)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+            self.framebuffer.unbind(self.window)
+        return results
+
+
+class RayPicker(object):
+    '''translates a click into UV coordinates by casting a ray from the camera at the pages
+    the folio is showing, including pages in the middle of a turn. Runs entirely on the CPU,
+    so results are ready in the same frame and picking on every mouse movement is cheap.
+    Has the same interface as PagePicker.'''
+    def __init__(self, camera, window, folio):
+        self.camera = camera
+        self.window = window
+        self.folio = folio
+        self.requests = []
+        self.hover = None
+
+    def pages(self):
+        for page in [self.folio.top_left, self.folio.top_right, self.folio.middle_left,
+                     self.folio.middle_right, self.folio.bottom_left, self.folio.bottom_right]:
+            if page is not None and page.mesh.visible:
+                yield page
+
+    @profiling.profiler.timed('RayPicker.__call__')
+    def __call__(self, x, y):
+        '''Returns (side, u, v) for window coordinates (x, y)'''
+        origin, direction = self.camera.unproject(x, y)
+        nearest = None
+        for page in self.pages():
+            hit = geometry.intersect_grid(page.current_vertices(), origin, direction)
+            if hit is not None and (nearest is None or hit[0] < nearest[0]):
+                nearest = hit
+        if nearest is None:
+            return (None, 0.0, 0.0)
+        t, column, row = nearest
+        #columns count out from the spine. Sides and u are assigned as PagePicker's colors do
+        if origin[0] + t*direction[0] >= 0:
+            return ('right', column/Page.width, row/Page.height)
+        return ('left', 1 - column/Page.width, row/Page.height)
+
+    def request(self, x, y, tag=None, hover=False):
+        '''queue a pick, answered by the next update(). Hover picks replace each other'''
+        if hover:
+            self.hover = (x, y, tag)
+        else:
+            self.requests.append((x, y, tag))
+
+    def pending(self):
+        return bool(self.requests) or self.hover is not None
+
+    @profiling.profiler.timed('RayPicker.update')
+    def update(self):
+        '''Returns: list of (x, y, tag, (side, u, v)) for every queued pick'''
+        if self.hover is not None:
+            self.requests.append(self.hover)
+            self.hover = None
+        results = [(x, y, tag, self(x, y)) for x, y, tag in self.requests]
+        self.requests = []
+        return results
+
+Book.picker_class = RayPicker
+
 
 def create_random_page():
     '''lorem ipsum generator'''
     text = '\t'+'\n\t'.join(get_paragraphs(2))
-    return pyglet.text.Label(text, x=100, y=924, width=824, height=400, multiline=True,
-                             color=[20, 12, 8, 200], font_name='Summertime', font_size=30)
+    return pagetext.PageText(text, x=100, y=924, width=824, color=[20, 12, 8, 200],
+                             font_name='Summertime', font_size=30)
 
@@ -0,0 +1,215 @@
+'''Where a book's pages come from. A PageSource gives random access to pages by number
+without holding them all, so a book can be far longer than what fits in memory: Book only
+turns the pages near the open spread into scenes, through a SceneCache, and drops the rest.
+Sources can generate pages, read them from a text file, or from a directory with one text
+or image file per page.'''
+import pyglet
+from loremipsum import get_paragraphs
+import loremipsum.generator
+import os
+import random
+import threading
+import assets
+import pagetext
+
+#guards loremipsum's module globals while lorem_page rebinds them
+lorem_lock = threading.Lock()
+
+
+def lorem_page(number):
+    '''two paragraphs of lorem ipsum, each indented. The same number always gives the same
+    text, so a page reads the same when it is generated again after being dropped. The text
+    comes from a random.Random of its own, so other users of the global random state, such as
+    the candle flicker, don't change it'''
+    rng = random.Random(number)
+    generator = loremipsum.generator
+    with lorem_lock:
+        #the generator calls these, imported from random, as module globals
+        saved = generator.choice, generator.normalvariate
+        generator.choice, generator.normalvariate = rng.choice, rng.normalvariate
+        try:
+            return '\t' + '\n\t'.join(get_paragraphs(2))
+        finally:
+            generator.choice, generator.normalvariate = saved
+
+
+def paragraphs(text):
+    '''joins the lines of text as written in a file into indented paragraphs, split at
+    blank lines, as PageText lays them out'''
+    blocks = [' '.join(block.split()) for block in text.replace('\r', '').split('\n\n')]
+    return '\n'.join(['\t' + block for block in blocks if block])
+
+
+class PageSource(object):
+    '''Random access to the pages of a book. Subclasses implement __len__ and text, or
+    override page for pages that aren't text'''
+    def __len__(self):
+        raise NotImplementedError
+
+    def is_text(self, number):
+        '''whether page number is made from text alone, so it can be prepared off the render
+        thread by a content.ContentPipeline'''
+        return True
+
+    def text(self, number):
+        '''text of page number, or None for a blank page. May be called on worker threads'''
+        return None
+
+    def page(self, number):
+        '''HUD object drawing page number onto its texture, or None for a blank page'''
+        text = self.text(number)
+        if text is None:
+            return None
+        return pagetext.PageText(text)
+
+
+class GeneratorSource(PageSource):
+    '''pages made by a function of the page number'''
+    def __init__(self, npages, generate=lorem_page):
+        '''generate (function): page number -> text. Should give the same text each time'''
+        self.npages = npages
+        self.generate = generate
+
+    def __len__(self):
+        return self.npages
+
+    def text(self, number):
+        return self.generate(number)
+
+
+class TextFileSource(PageSource):
+    '''Pages cut from one text file. The file is scanned once for where pages begin and each
+    page is read back when needed, so only the offsets are kept in memory'''
+    def __init__(self, path, chars_per_page=900):
+        '''
+        Parameters:
+            path (str): text file. Paragraphs are separated by blank lines, and a form feed
+                forces a page break
+            chars_per_page (int): pages break at the first line end past this length
+        '''
+        self.path = path
+        self.offsets = [0] #byte offset of each page, and the end of the file
+        with open(path, 'rb') as text_file:
+            length = 0
+            offset = 0
+            for line in text_file:
+                if line.startswith('\f') or (length and length + len(line) > chars_per_page):
+                    self.offsets.append(offset)
+                    length = 0
+                length += len(line)
+                offset += len(line)
+        self.offsets.append(offset)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text(self, number):
+        with open(self.path, 'rb') as text_file:
+            text_file.seek(self.offsets[number])
+            text = text_file.read(self.offsets[number + 1] - self.offsets[number])
+        return paragraphs(text.decode('utf-8', 'replace').replace(u'\f', u''))
+
+
+class ImagePage(object):
+    '''HUD object drawing an image file centered in a box on the page, scaled to fit.
+    The image is loaded on first draw'''
+    def __init__(self, path, x=100, y=100, width=824, height=824):
+        self.path = path
+        self.box = (x, y, width, height)
+        self.image = None #from assets.cache, released by delete
+        self.sprite = None
+
+    def draw(self):
+        if self.sprite is None:
+            x, y, width, height = self.box
+            image = self.image = assets.cache.image(self.path)
+            self.sprite = pyglet.sprite.Sprite(image)
+            self.sprite.scale = min(width*1.0/image.width, height*1.0/image.height)
+            self.sprite.x = x + (width - self.sprite.width)/2.0
+            self.sprite.y = y + (height - self.sprite.height)/2.0
+        self.sprite.draw()
+
+    def delete(self):
+        if self.sprite is not None:
+            #not self.sprite.image, which is the texture the sprite made from the image
+            assets.cache.release(self.image)
+            self.image = None
+            self.sprite.delete()
+            self.sprite = None
+
+
+class DirectorySource(PageSource):
+    '''one page per text or image file in a directory, in name order'''
+    text_extensions = ('.txt',)
+    image_extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+    def __init__(self, path):
+        self.path = path
+        extensions = self.text_extensions + self.image_extensions
+        self.files = sorted([name for name in os.listdir(path)
+                             if os.path.splitext(name)[1].lower() in extensions])
+
+    def __len__(self):
+        return len(self.files)
+
+    def file(self, number):
+        return os.path.join(self.path, self.files[number])
+
+    def is_text(self, number):
+        return os.path.splitext(self.files[number])[1].lower() in self.text_extensions
+
+    def text(self, number):
+        if not self.is_text(number):
+            return None
+        with open(self.file(number), 'rb') as text_file:
+            return paragraphs(text_file.read().decode('utf-8', 'replace'))
+
+    def page(self, number):
+        if self.is_text(number):
+            return PageSource.page(self, number)
+        return ImagePage(self.file(number))
+
+
+class SceneCache(object):
+    '''The scenes of the pages around the open spread. Scenes are made from page numbers on
+    first use and dropped once they fall outside the window, so memory use doesn't grow with
+    the length of the book'''
+    def __init__(self, count, create, drop, radius):
+        '''
+        Parameters:
+            count (int): pages in the book
+            create (function): page number -> scene
+            drop (function): called with a scene when it leaves the cache
+            radius (int): pages kept on either side of the open spread
+        '''
+        self.count = count
+        self.create = create
+        self.drop = drop
+        self.radius = radius
+        self.scenes = {} #page number: scene
+
+    def __getitem__(self, number):
+        if not 0 <= number < self.count:
+            raise IndexError, "page %i out of range" %number
+        if number not in self.scenes:
+            self.scenes[number] = self.create(number)
+        return self.scenes[number]
+
+    def __contains__(self, number):
+        return number in self.scenes
+
+    def __len__(self):
+        return len(self.scenes)
+
+    def window(self, current):
+        '''numbers of the pages kept while the spread starting at current is open'''
+        return range(max(0, current - self.radius), min(self.count, current + 2 + self.radius))
+
+    def slide(self, current):
+        '''make the scenes of the window around current and drop the ones outside it'''
+        kept = set(self.window(current))
+        for number in self.scenes.keys():
+            if number not in kept:
+                self.drop(self.scenes.pop(number))
+        for number in sorted(kept, key=lambda number: abs(number - current)):
+            self[number]
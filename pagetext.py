@@ -0,0 +1,185 @@
+'''Page text drawn from a shared glyph atlas. A pyglet Label lays out and uploads its own
+glyph quads, which for a book of hundreds of pages dominates startup. Here every page in a
+given font and size shares one atlas texture, holding the glyphs rendered once up front, and
+layouts are cached by text, font, size and width. A page's text is laid out and turned into
+a single vertex list only when it is first drawn, so pages far from the open spread cost
+nothing until the reader gets near them.'''
+import pyglet
+from pyglet.gl import *
+from collections import OrderedDict
+import os
+import string
+
+FONT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts')
+#font name: file in FONT_DIRECTORY, registered with pyglet the first time the font is used
+FONT_FILES = {'Summertime': 'Summerti.ttf'}
+registered = set()
+
+
+def load_font(name, size):
+    if name in FONT_FILES and name not in registered:
+        pyglet.font.add_file(os.path.join(FONT_DIRECTORY, FONT_FILES[name]))
+        registered.add(name)
+    return pyglet.font.load(name, size)
+
+
+class GlyphAtlas(object):
+    '''The glyphs of one font at one size, packed into a single texture'''
+    texture_size = 1024
+    characters = string.letters + string.digits + string.punctuation + ' '
+
+    def __init__(self, font_name, font_size):
+        self.font_name = font_name
+        self.font_size = font_size
+        self.font = load_font(font_name, font_size)
+        #large enough that the printable characters all share the first texture
+        self.font.texture_width = self.font.texture_height = self.texture_size
+        self.glyphs = {}
+        self.advances = {}
+        self.add(self.characters)
+        self.line_height = self.font.ascent - self.font.descent
+        self.tab = 4*self.advances[' ']
+
+    def add(self, text):
+        '''render any glyphs in text not in the atlas yet'''
+        missing = [c for c in set(text) if c not in self.glyphs]
+        for c, glyph in zip(missing, self.font.get_glyphs(u''.join(missing))):
+            self.glyphs[c] = glyph
+            self.advances[c] = glyph.advance
+
+    def quads(self, positions, x, y, color):
+        '''
+        Parameters:
+            positions: from layout, relative to (x, y)
+            color (4 ints): rgba, 0 to 255
+        Returns: dict of texture: (vertices, tex_coords, colors) lists for GL_QUADS
+        '''
+        self.add([c for c, px, py in positions])
+        quads = {}
+        for c, px, py in positions:
+            glyph = self.glyphs[c]
+            left, bottom, right, top = glyph.vertices
+            if left == right:
+                continue
+            left, right = left + x + px, right + x + px
+            bottom, top = bottom + y + py, top + y + py
+            vertices, tex_coords, colors = quads.setdefault(glyph.owner, ([], [], []))
+            vertices.extend((left, bottom, right, bottom, right, top, left, top))
+            tex_coords.extend(glyph.tex_coords)
+            colors.extend(color*4)
+        return quads
+
+
+atlases = {} #(font name, size): GlyphAtlas
+
+def get_atlas(font_name, font_size):
+    key = (font_name, font_size)
+    if key not in atlases:
+        atlases[key] = GlyphAtlas(font_name, font_size)
+    return atlases[key]
+
+
+def layout(text, advances, width, line_height, tab, default_advance=0):
+    '''
+    Word wraps text. Needs only glyph metrics, not a GL context.
+    Parameters:
+        advances (dict): character: horizontal advance in pixels
+        width (float): line width to wrap at
+        line_height (float): distance between baselines
+        tab (float): indent for a tab
+        default_advance (float): advance of characters missing from advances
+    Returns: list of (character, x, y), with y the baseline: 0 for the first line and
+        decreasing downwards
+    '''
+    def advance(c):
+        return advances.get(c, default_advance)
+    positions = []
+    y = 0
+    for paragraph in text.split('\n'):
+        x = 0
+        for word in paragraph.split(' '):
+            if x and x + sum([advance(c) for c in word.lstrip('\t')]) > width:
+                x = 0
+                y -= line_height
+            for c in word:
+                if c == '\t':
+                    x += tab
+                else:
+                    positions.append((c, x, y))
+                    x += advance(c)
+            x += advance(' ')
+        y -= line_height
+    return positions
+
+
+class LayoutCache(object):
+    '''recently used layouts, keyed by text, font, size and width'''
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.layouts = OrderedDict()
+
+    def get(self, text, atlas, width):
+        key = (text, atlas.font_name, atlas.font_size, width)
+        if key in self.layouts:
+            positions = self.layouts.pop(key)
+        else:
+            positions = layout(text, atlas.advances, width, atlas.line_height, atlas.tab,
+                               atlas.advances[' '])
+            if len(self.layouts) >= self.max_entries:
+                self.layouts.popitem(last=False)
+        self.layouts[key] = positions
+        return positions
+
+    def __len__(self):
+        return len(self.layouts)
+
+
+#shared by all page text
+layouts = LayoutCache()
+
+
+class PageText(object):
+    '''HUD object drawing a block of text, like a multiline Label anchored at the first
+    baseline, as one vertex list of quads on the shared atlas texture'''
+    def __init__(self, text, x=100, y=924, width=824, font_name='Summertime', font_size=30,
+                 color=(20, 12, 8, 200), positions=None):
+        '''positions (None or list): result of layout if already done, for example by
+        content.ContentPipeline. Otherwise text is laid out through the shared cache'''
+        self.text = text
+        self.positions = positions
+        self.x = x
+        self.y = y
+        self.width = width
+        self.font_name = font_name
+        self.font_size = font_size
+        self.color = tuple(color)
+        self.vertex_lists = None #[(texture, vertex list)], made on first draw
+
+    def prepare(self):
+        atlas = get_atlas(self.font_name, self.font_size)
+        positions = self.positions
+        if positions is None:
+            positions = layouts.get(self.text, atlas, self.width)
+        self.vertex_lists = []
+        for texture, (vertices, tex_coords, colors) in atlas.quads(
+                positions, self.x, self.y, self.color).items():
+            self.vertex_lists.append((texture, pyglet.graphics.vertex_list(
+                len(vertices)//2, ('v2f/static', vertices), ('t3f/static', tex_coords),
+                ('c4B/static', colors))))
+
+    def draw(self):
+        if self.vertex_lists is None:
+            self.prepare()
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        for texture, vertex_list in self.vertex_lists:
+            glEnable(texture.target)
+            glBindTexture(texture.target, texture.id)
+            vertex_list.draw(GL_QUADS)
+            glDisable(texture.target)
+
+    def delete(self):
+        if self.vertex_lists is not None:
+            for texture, vertex_list in self.vertex_lists:
+                vertex_list.delete()
+            self.vertex_lists = None
@@ -0,0 +1,115 @@
+'''Opt-in timing of the hot paths in a frame. Functions are instrumented with the timed
+decorator, which costs one attribute check while profiling is off. When it is on, each call's
+duration goes into a fixed-size ring buffer per name, for live percentiles, and into a
+bounded event log that can be exported for chrome://tracing or Perfetto.'''
+import pyglet
+import numpy as np
+from collections import deque
+from functools import wraps
+import json
+import time
+
+
+class Profiler(object):
+    def __init__(self, capacity=600, max_events=20000):
+        '''
+        Parameters:
+            capacity (int): most recent durations kept per name for the statistics
+            max_events (int): most recent calls kept for trace export
+        '''
+        self.enabled = False
+        self.capacity = capacity
+        self.durations = {} #name: ring buffer of seconds
+        self.counts = {} #name: calls recorded in total
+        self.events = deque(maxlen=max_events) #(name, start, duration)
+        self.origin = time.time()
+
+    def record(self, name, start, duration):
+        if name not in self.durations:
+            self.durations[name] = np.zeros(self.capacity)
+            self.counts[name] = 0
+        self.durations[name][self.counts[name] % self.capacity] = duration
+        self.counts[name] += 1
+        self.events.append((name, start, duration))
+
+    def timed(self, name):
+        '''decorator recording the duration of every call under name while enabled'''
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.time()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, start, time.time() - start)
+            return wrapper
+        return decorate
+
+    def call(self, name, function, *args):
+        '''call function with args, recording its duration under name while enabled, for
+        callables only known at run time'''
+        if not self.enabled:
+            return function(*args)
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.record(name, start, time.time() - start)
+
+    def samples(self, name):
+        '''recorded durations in seconds, oldest entries possibly overwritten'''
+        count = self.counts.get(name, 0)
+        return self.durations[name][:min(count, self.capacity)] if count else np.zeros(0)
+
+    def percentiles(self, name, q=(50, 95, 99)):
+        '''durations in milliseconds at percentiles q, over the samples in the ring buffer'''
+        samples = self.samples(name)
+        if not len(samples):
+            return [0.0]*len(q)
+        return list(1000*np.percentile(samples, q))
+
+    def report(self):
+        lines = ['%-28s %6s %7s %7s %7s' %('ms', 'calls', 'p50', 'p95', 'p99')]
+        for name in sorted(self.durations):
+            lines.append('%-28s %6i %7.3f %7.3f %7.3f' %(
+                (name, self.counts[name]) + tuple(self.percentiles(name))))
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, path):
+        '''write the event log in the Trace Event Format, times in microseconds'''
+        trace = [{'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                  'ts': int(1e6*(start - self.origin)), 'dur': int(1e6*duration)}
+                 for name, start, duration in self.events]
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, trace_file)
+
+    def reset(self):
+        self.durations = {}
+        self.counts = {}
+        self.events.clear()
+        self.origin = time.time()
+
+
+class ProfilerOverlay(object):
+    '''HUD object showing the profiler's live statistics. Add with Scene.add_hud_object'''
+    def __init__(self, profiler, x=10, y=10, interval=.5):
+        '''interval (float): seconds between text refreshes, since laying out text is slow'''
+        self.profiler = profiler
+        self.interval = interval
+        self.refreshed = 0
+        self.label = pyglet.text.Label('', font_name='Courier New', font_size=9, x=x, y=y,
+                                       width=480, multiline=True, anchor_y='bottom',
+                                       color=(255, 255, 160, 255))
+
+    def draw(self):
+        now = time.time()
+        if now - self.refreshed > self.interval:
+            self.label.text = self.profiler.report()
+            self.refreshed = now
+        self.label.draw()
+
+
+#shared by all instrumented code
+profiler = Profiler()
@@ -0,0 +1,239 @@
+'''GLSL programs. Everything here is written against GLSL 1.20 (OpenGL 2.1) with the
+fixed-function built-in state, which Mesa's software rasterizers support, and everything that
+uses a shader keeps a fixed-function path for when compiling fails.'''
+import pyglet
+from pyglet.gl import *
+from pyglet.gl.lib import GLException, MissingFunctionException
+import ctypes
+
+
+class ShaderError(Exception):
+    pass
+
+#what building or binding a program raises where shaders can't be used: the driver rejecting
+#the source, a GL error, or an entry point missing from an OpenGL older than 2.0
+UNAVAILABLE = (ShaderError, GLException, MissingFunctionException)
+
+
+class ShaderProgram(object):
+    '''a linked vertex and (optionally) fragment shader'''
+    def __init__(self, vertex_source, fragment_source=None, attributes={}):
+        '''
+        Parameters:
+            vertex_source, fragment_source (str): GLSL source
+            attributes (dict): generic attribute name: index, bound before linking so vertex
+                lists can use pyglet's '<index>g' attribute formats
+        Raises ShaderError with the driver's log if compiling or linking fails
+        '''
+        self.id = glCreateProgram()
+        self.shaders = [self.compile(GL_VERTEX_SHADER, vertex_source)]
+        if fragment_source is not None:
+            self.shaders.append(self.compile(GL_FRAGMENT_SHADER, fragment_source))
+        for shader in self.shaders:
+            glAttachShader(self.id, shader)
+        for name, index in attributes.items():
+            glBindAttribLocation(self.id, index, name)
+        glLinkProgram(self.id)
+        status = GLint()
+        glGetProgramiv(self.id, GL_LINK_STATUS, status)
+        if not status.value:
+            log = self.log(glGetProgramiv, glGetProgramInfoLog, self.id)
+            self.delete()
+            raise ShaderError, "link failed: %s" %log
+        self.locations = {}
+
+    def compile(self, kind, source):
+        shader = glCreateShader(kind)
+        text = ctypes.create_string_buffer(source)
+        pointer = ctypes.cast(ctypes.pointer(ctypes.pointer(text)),
+                              ctypes.POINTER(ctypes.POINTER(GLchar)))
+        glShaderSource(shader, 1, pointer, None)
+        glCompileShader(shader)
+        status = GLint()
+        glGetShaderiv(shader, GL_COMPILE_STATUS, status)
+        if not status.value:
+            log = self.log(glGetShaderiv, glGetShaderInfoLog, shader)
+            glDeleteShader(shader)
+            raise ShaderError, "compile failed: %s" %log
+        return shader
+
+    @staticmethod
+    def log(get_parameter, get_log, object_id):
+        length = GLint()
+        get_parameter(object_id, GL_INFO_LOG_LENGTH, length)
+        text = ctypes.create_string_buffer(max(length.value, 1))
+        get_log(object_id, len(text), None, text)
+        return text.value
+
+    def bind(self):
+        glUseProgram(self.id)
+
+    def unbind(self):
+        glUseProgram(0)
+
+    def location(self, name):
+        if name not in self.locations:
+            self.locations[name] = glGetUniformLocation(self.id, name)
+        return self.locations[name]
+
+    def set_float(self, name, value):
+        '''program must be bound'''
+        glUniform1f(self.location(name), value)
+
+    def set_int(self, name, value):
+        glUniform1i(self.location(name), value)
+
+    def set_vector(self, name, values):
+        '''set a vec4 uniform'''
+        glUniform4f(self.location(name), *values)
+
+    def set_floats(self, name, values):
+        '''set a float array uniform from a ctypes array of GLfloat'''
+        glUniform1fv(self.location(name), len(values), values)
+
+    def delete(self):
+        for shader in self.shaders:
+            glDeleteShader(shader)
+        glDeleteProgram(self.id)
+        self.shaders = []
+
+
+#Fixed-function lighting with glColorMaterial(GL_AMBIENT_AND_DIFFUSE), as lights.LightSet
+#sets it up. LightSet enables all eight lights and zeroes the unused ones, so summing every
+#gl_LightSource matches. Materials have no specular or emission, so those terms are left out
+LIGHTING_GLSL = '''
+vec4 light_vertex(vec3 position, vec3 normal, vec4 color) {
+    vec4 total = gl_LightModel.ambient*color;
+    for (int i = 0; i < 8; i++) {
+        vec3 direction;
+        float attenuation = 1.0;
+        if (gl_LightSource[i].position.w == 0.0) {
+            direction = normalize(gl_LightSource[i].position.xyz);
+        } else {
+            direction = gl_LightSource[i].position.xyz - position;
+            float dist = length(direction);
+            direction /= dist;
+            attenuation = 1.0/(gl_LightSource[i].constantAttenuation
+                               + gl_LightSource[i].linearAttenuation*dist
+                               + gl_LightSource[i].quadraticAttenuation*dist*dist);
+            if (gl_LightSource[i].spotCutoff != 180.0) {
+                float spot = dot(-direction, normalize(gl_LightSource[i].spotDirection));
+                if (spot < gl_LightSource[i].spotCosCutoff) {
+                    attenuation = 0.0;
+                } else {
+                    attenuation *= pow(spot, gl_LightSource[i].spotExponent);
+                }
+            }
+        }
+        float diffuse = max(dot(normal, direction), 0.0);
+        total += attenuation*(gl_LightSource[i].ambient
+                              + diffuse*gl_LightSource[i].diffuse)*color;
+    }
+    return vec4(total.rgb, color.a);
+}
+'''
+
+#rotates each column of a page about the y axis by progress*angles[column], as
+#geometry.flap does on the CPU
+PAGE_CURL_VERTEX = '''#version 120
+uniform float angles[%(columns)i];
+uniform float progress;
+attribute float column;
+%(lighting)s
+void main() {
+    float angle = progress*angles[int(column + 0.5)];
+    float c = cos(angle);
+    float s = sin(angle);
+    mat3 rotation = mat3(c, 0.0, -s,  0.0, 1.0, 0.0,  s, 0.0, c);
+    vec4 vertex = vec4(rotation*gl_Vertex.xyz, 1.0);
+    vec3 normal = normalize(gl_NormalMatrix*(rotation*gl_Normal));
+    vec4 position = gl_ModelViewMatrix*vertex;
+    gl_FrontColor = light_vertex(position.xyz, normal, gl_Color);
+    gl_TexCoord[0] = gl_MultiTexCoord0;
+    gl_Position = gl_ProjectionMatrix*position;
+}
+'''
+
+#GL_MODULATE texturing
+TEXTURED_FRAGMENT = '''#version 120
+uniform sampler2D page_texture;
+void main() {
+    gl_FragColor = gl_Color*texture2D(page_texture, gl_TexCoord[0].st);
+}
+'''
+
+#draws one leaf of geometry.make_leaf per instance. Each instance has its own mirroring
+#(1 for the right stack, -1 for the left), depth below the open pages, thickness and shade
+PAGE_STACK_VERTEX = '''#version 120
+uniform vec4 page_color;
+attribute float drop;
+attribute vec4 instance;
+%(lighting)s
+void main() {
+    vec4 vertex = vec4(instance.x*gl_Vertex.x, gl_Vertex.y,
+                       gl_Vertex.z - instance.y - drop*instance.z, 1.0);
+    vec3 normal = normalize(gl_NormalMatrix*vec3(instance.x*gl_Normal.x, gl_Normal.yz));
+    vec4 position = gl_ModelViewMatrix*vertex;
+    gl_FrontColor = light_vertex(position.xyz, normal, vec4(instance.w*page_color.rgb,
+                                                            page_color.a));
+    gl_Position = gl_ProjectionMatrix*position;
+}
+'''
+
+#generic attribute index for the page column. Avoids the indices some drivers alias to
+#gl_Vertex, gl_Normal, gl_Color and the texture coordinates
+COLUMN_ATTRIBUTE = 6
+#generic attribute indices for the page stack, which doesn't use the column
+DROP_ATTRIBUTE = 6
+INSTANCE_ATTRIBUTE = 7
+
+
+def instancing_supported():
+    '''whether the context has glDrawElementsInstanced and glVertexAttribDivisor'''
+    return gl_info.have_version(3, 3)
+
+
+def page_stack_program():
+    '''Returns: ShaderProgram for PAGE_STACK_VERTEX, or raises ShaderError'''
+    vertex_source = PAGE_STACK_VERTEX %{'lighting': LIGHTING_GLSL}
+    return ShaderProgram(vertex_source, None, {'drop': DROP_ATTRIBUTE,
+                                               'instance': INSTANCE_ATTRIBUTE})
+
+
+def page_curl_program(columns):
+    '''
+    Parameters:
+        columns (int): vertex columns in the page mesh, i.e. Page.width + 1
+    Returns: ShaderProgram, or raises ShaderError
+    '''
+    vertex_source = PAGE_CURL_VERTEX %{'columns': columns, 'lighting': LIGHTING_GLSL}
+    program = ShaderProgram(vertex_source, TEXTURED_FRAGMENT, {'column': COLUMN_ATTRIBUTE})
+    program.bind()
+    program.set_int('page_texture', 0)
+    program.unbind()
+    return program
+
+
+class CurlGroup(pyglet.graphics.Group):
+    '''Binds the page curl program with one page's turn state. A turn then only has to change
+    progress; the page's vertices stay resident in their flat or curved rest pose'''
+    def __init__(self, program, columns, parent=None):
+        pyglet.graphics.Group.__init__(self, parent)
+        self.program = program
+        self.angles = (GLfloat * columns)()
+        self.angles_source = None
+        self.progress = 0.0
+
+    def set_angles(self, angles):
+        '''full-turn angle for each column. Only copied when a different array is passed'''
+        if angles is not self.angles_source:
+            self.angles[:] = [float(angle) for angle in angles]
+            self.angles_source = angles
+
+    def set_state(self):
+        self.program.bind()
+        self.program.set_floats('angles', self.angles)
+        self.program.set_float('progress', self.progress)
+
+    def unset_state(self):
+        self.program.unbind()
@@ -0,0 +1,43 @@
+'''Per-frame event counters. Cheap enough to leave on all the time, and useful for confirming
+that caches and batching are actually saving work. Counts accumulate during a frame and the
+Director rolls them over once per drawn frame.'''
+
+
+class FrameCounter(object):
+    '''named counts for the frame in progress and the last completed frame'''
+    def __init__(self):
+        self.current = {}
+        self.last = {}
+        self.totals = {}
+        self.frames = 0
+
+    def count(self, name, n=1):
+        self.current[name] = self.current.get(name, 0) + n
+
+    def new_frame(self):
+        '''finish the frame in progress'''
+        for name, n in self.current.items():
+            self.totals[name] = self.totals.get(name, 0) + n
+        self.last = self.current
+        self.current = {}
+        self.frames += 1
+
+    def get(self, name):
+        '''count for the last completed frame'''
+        return self.last.get(name, 0)
+
+    def average(self, name):
+        '''mean count per frame since the counter was created or reset'''
+        if not self.frames:
+            return 0.0
+        return self.totals.get(name, 0)*1.0/self.frames
+
+    def reset(self):
+        self.__init__()
+
+    def report(self):
+        return ', '.join(['%s: %i' %(name, self.last[name]) for name in sorted(self.last)])
+
+
+#shared by the whole process, since there is only one render loop
+counters = FrameCounter()
@@ -0,0 +1,60 @@
+'''Run from the repository root with
+    python -m unittest discover -s tests -t .
+The image page tests need a GL context, from headless.OffscreenWindow, and are skipped
+where Mesa's surfaceless EGL isn't available.'''
+import headless
+import os
+import shutil
+import tempfile
+import unittest
+import assets
+import framebuffer
+import pagesource
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ImagePageTest(unittest.TestCase):
+    def setUp(self):
+        try:
+            self.window = headless.OffscreenWindow(64, 64)
+        except headless.EGLError, error:
+            raise unittest.SkipTest('no GL context: %s' %error)
+        #there is no default framebuffer to draw into. Creating one leaves it bound
+        self.window.render_target = framebuffer.Framebuffer(64, 64)
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(os.path.join(ROOT, 'wood.png'), self.directory)
+        self.source = pagesource.DirectorySource(self.directory)
+        self.path = self.source.file(0)
+        self.key = ('image', os.path.abspath(self.path))
+
+    def tearDown(self):
+        assets.cache.evict(self.path)
+        shutil.rmtree(self.directory)
+        del self.window.render_target
+        self.window.close()
+
+    def references(self):
+        return assets.cache.entries[self.key][1]
+
+    def test_delete_releases_image(self):
+        page = self.source.page(0)
+        page.draw()
+        self.assertEqual(self.references(), 1)
+        page.delete()
+        self.assertEqual(self.references(), 0)
+        self.assertEqual(assets.cache.evict(self.path), 1)
+
+    def test_draw_after_delete(self):
+        page = self.source.page(0)
+        page.draw()
+        page.delete()
+        page.draw()
+        self.assertEqual(self.references(), 1)
+        page.delete()
+        page.delete()
+        self.assertEqual(self.references(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,82 +4,236 @@ from camera import Camera
 import numpy as np
 import director as dr
 import lights
-'''converts WaveFront files into nested lists of vertices, normals, and texture coordinates,
-suitable for flattening and passing as pyglet vertex lists. Only designed to work with
-simple blender objects, not to match the full spec.'''
+import hashlib
+import os
+import tempfile
+import zipfile
+'''converts WaveFront files into numpy arrays of vertices, normals, and texture coordinates,
+suitable for flattening and passing as pyglet vertex lists. Handles the geometry parts of
+the format (v, vt, vn, f and o lines) but ignores materials, groups and smoothing.'''
 
 class WaveParser:
+    #compiled copies of parsed files are kept here, see load
+    cache_dir = '.meshcache'
+    cache_version = 2
+
     def __init__(self):
         self.vertices = None
         self.normals = None
         self.tex_coords = None
 
-    def parse(self, mfile):
-        lines = mfile.readlines()
-        self.vertices, self.normals, self.tex_coords = [], [], []
-        raw_vertices, raw_normals, raw_tex_coords = [], [], []
-        raw_indices = {}
-        self.index_array = {}
-        used_vertices, used_normals, used_tex_coords = set(), set(), set()
-        combos = {}
-        
-        for i, line in enumerate(lines):
-            vals = line.lower().strip().split()
-            if vals[0] == 'o':
-                trimmed = vals[1].split('_')[0]
-                raw_indices[trimmed] = []
-                curr_indices = raw_indices[trimmed]
-            elif vals[0] == 'v':
-                raw_vertices.append([float(val) for val in vals[1:4]])
-            elif vals[0] == 'vn':
-                raw_normals.append([float(val) for val in vals[1:4]])
-            elif vals[0] == 'vt':
-                raw_tex_coords.append([float(val) for val in vals[1:3]])
-            elif vals[0] == 'f':
-                curr_indices.append(vals[1:])
-
-        def extend_lists(val):
-            if not val in combos:
-                v, t, n = val.split('/')
+    def load(self, path, use_cache=True):
+        '''
+        parse a WaveFront file, reusing the compiled copy in cache_dir if the source hasn't
+        changed since it was written. A copy is valid if the source's mtime and size match,
+        or failing that if its content hash does.
+        '''
+        if use_cache and self.load_compiled(path):
+            return
+        with open(path) as mfile:
+            self.parse(mfile)
+        if use_cache:
+            self.save_compiled(path)
+
+    def compiled_path(self, path):
+        name = hashlib.sha1(os.path.abspath(path)).hexdigest()[:16]
+        return os.path.join(self.cache_dir, '%s-%s.npz' %(os.path.basename(path), name))
+
+    def load_compiled(self, path):
+        '''Returns: True if a valid compiled copy was loaded'''
+        try:
+            compiled = np.load(self.compiled_path(path))
+        except IOError:
+            return False
+        try:
+            with compiled:
+                stat = os.stat(path)
+                if compiled['version'] != self.cache_version:
+                    return False
+                digest = None
+                if compiled['mtime'] != stat.st_mtime or compiled['size'] != stat.st_size:
+                    digest = file_hash(path)
+                    if str(compiled['hash']) != digest:
+                        return False
+                vertices = compiled['vertices']
+                normals = compiled['normals']
+                tex_coords = compiled['tex_coords']
+                indices = {}
+                for name in compiled.files:
+                    if name.startswith('indices_'):
+                        indices[name[len('indices_'):]] = compiled[name]
+        except (KeyError, ValueError, zipfile.BadZipfile):
+            #written by another version, or damaged. It gets replaced
+            return False
+        self.vertices, self.normals, self.tex_coords = vertices, normals, tex_coords
+        self.indices = indices
+        if digest is not None:
+            #only touched, for example by a checkout. Record the new mtime and size so later
+            #loads don't hash the whole file again
+            self.save_compiled(path, digest)
+        return True
+
+    def save_compiled(self, path, digest=None):
+        '''
+        write the parsed mesh to cache_dir. Failing to write is not an error
+        Parameters:
+            digest (None or str): file_hash(path), if already known
+        '''
+        stat = os.stat(path)
+        if digest is None:
+            digest = file_hash(path)
+        arrays = dict([('indices_' + key, np.array(val, dtype=np.int32))
+                       for key, val in self.indices.items()])
+        temp_path = None
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            handle, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(handle, 'wb') as temp:
+                np.savez(temp, version=self.cache_version, mtime=stat.st_mtime,
+                         size=stat.st_size, hash=digest, vertices=self.vertices,
+                         normals=self.normals, tex_coords=self.tex_coords, **arrays)
+            compiled_path = self.compiled_path(path)
+            if os.path.exists(compiled_path):
+                os.remove(compiled_path)
+            os.rename(temp_path, compiled_path)
+            temp_path = None
+        except (IOError, OSError):
+            pass
+        finally:
+            #left over if writing or renaming failed
+            if temp_path is not None and os.path.exists(temp_path):
                 try:
-                    self.vertices.append(raw_vertices[int(v)-1])
-                    self.normals.append(raw_normals[int(n)-1])
-                    self.tex_coords.append(raw_tex_coords[int(t)-1])
-                except IndexError:
-                    print v, t, n
-                    print len(raw_vertices)
-                    print len(raw_normals)
-                    print len(raw_tex_coords)
-                    assert False
-                combos[val] = len(self.vertices) - 1
-            return combos[val]
-                
-        for key, val in raw_indices.items():
-            self.index_array[key] = []
-            for indices in val:
-                self.index_array[key].append([extend_lists(v) for v in indices])
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def parse(self, mfile, chunk_size=2**22):
+        '''
+        parse an open WaveFront file. The file is read in chunks of chunk_size bytes and each
+        chunk's v, vt, vn and f lines are converted in bulk, so only the parsed arrays are
+        held in memory. Faces with more than three corners are fan triangulated, and negative
+        (relative) indices are supported.
+        '''
+        self.raw = {'v': [], 'vt': [], 'vn': []}
+        self.counts = {'v': 0, 'vt': 0, 'vn': 0}
+        self.object_names = []
+        self.triangles = [] #(corners, object) arrays for each chunk
+        current = None
+        tail = ''
+        while True:
+            chunk = mfile.read(chunk_size)
+            if not chunk:
+                break
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            current = self.parse_lines(lines, current)
+        self.parse_lines([tail], current)
         self.cleanup()
 
+    def parse_lines(self, lines, current):
+        '''
+        Parameters:
+            lines (list of str): complete lines
+            current (None or int): index into object_names of the object faces belong to
+        Returns: the object faces belong to after these lines
+        '''
+        words = [line.split(None, 1) for line in lines]
+        keys = [(word[0].lower() if word else '') for word in words]
+        for word in words:
+            if len(word) == 1:
+                word.append('')
+        codes = np.array([_line_codes.get(key, 0) for key in keys], dtype=np.int8)
+        if not codes.any():
+            return current
+        for key, width in (('v', 3), ('vt', 2), ('vn', 3)):
+            rows = np.flatnonzero(codes == _line_codes[key])
+            if len(rows):
+                self.raw[key].append(_parse_floats([words[i][1] for i in rows], width))
+        #counts of each element defined before each line, to resolve relative indices
+        counts = [self.counts[key] + np.cumsum(codes == _line_codes[key])
+                  for key in ('v', 'vt', 'vn')]
+        object_rows = np.flatnonzero(codes == _line_codes['o'])
+        object_ids = [current]
+        for i in object_rows:
+            name = (words[i][1].split() or [''])[0].lower().split('_')[0]
+            if name not in self.object_names:
+                self.object_names.append(name)
+            object_ids.append(self.object_names.index(name))
+        face_rows = np.flatnonzero(codes == _line_codes['f'])
+        if len(face_rows):
+            #faces before the first object line belong to the object carried over
+            face_objects = np.array(object_ids)[np.searchsorted(object_rows, face_rows)]
+            if None in face_objects.tolist():
+                if 'default' not in self.object_names:
+                    self.object_names.append('default')
+                default = self.object_names.index('default')
+                face_objects = np.array([default if o is None else o for o in face_objects])
+            corners, values = _parse_faces([words[i][1] for i in face_rows])
+            for column, count in enumerate(counts):
+                #OBJ indices start at 1, negative ones count back from the newest element,
+                #and 0 marks a missing texture coordinate or normal
+                defined = np.repeat(count[face_rows], corners)
+                index = values[:, column]
+                values[:, column] = np.where(index > 0, index - 1,
+                                             np.where(index < 0, defined + index, -1))
+            self.triangles.append(_fan_triangulate(values, corners, face_objects.astype(int)))
+        for key, count in zip(('v', 'vt', 'vn'), counts):
+            self.counts[key] = int(count[-1])
+        return object_ids[-1]
+
     def cleanup(self):
-        self.vertices = np.array(self.vertices)
-        self.normals = np.array(self.normals)
-        self.tex_coords = np.array(self.tex_coords)
+        '''merge the chunks, and give each distinct v/vt/vn combination one vertex'''
+        raw = {}
+        for key, width in (('v', 3), ('vt', 2), ('vn', 3)):
+            #a trailing row of zeros stands in for missing (index -1) elements
+            raw[key] = np.concatenate(self.raw[key] + [np.zeros((1, width))])
+        if self.triangles:
+            corners = np.concatenate([c for c, o in self.triangles]).reshape(-1, 3)
+            objects = np.concatenate([o for c, o in self.triangles])
+        else:
+            corners = np.zeros((0, 3), dtype=np.int64)
+            objects = np.zeros(0, dtype=int)
+        for column, key in enumerate(('v', 'vt', 'vn')):
+            if len(corners) and (corners[:, column].max() >= len(raw[key]) - 1 or
+                                 corners[:, column].min() < -1):
+                raise ValueError, "face refers to a missing %s element" %key
+            if key == 'v' and len(corners) and corners[:, 0].min() < 0:
+                raise ValueError, "face corner without a vertex"
+        #number the combinations in order of first appearance. Each corner's row is viewed
+        #as one opaque value, so corners only merge if all three indices match; packing them
+        #into one integer could wrap around for meshes with millions of elements
+        corners = np.ascontiguousarray(corners, dtype=np.int64)
+        keys = corners.view(np.dtype((np.void, corners.strides[0]))).ravel()
+        unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        if len(first) > np.iinfo(np.int32).max:
+            raise ValueError, "%i distinct vertices don't fit 32 bit indices" %len(first)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        combos = corners[first[order]]
+        self.vertices = raw['v'][combos[:, 0]]
+        self.tex_coords = raw['vt'][combos[:, 1]]
+        self.normals = raw['vn'][combos[:, 2]]
+        triangles = rank[inverse].reshape(-1, 3).astype(np.int32)
+        self.index_array = {}
+        for i, name in enumerate(self.object_names):
+            self.index_array[name] = triangles[objects == i]
+        del self.raw, self.triangles
         self.fix_indices()
 
     def fix_indices(self):
         '''set index sequences so they are counter-clockwise when the average of the
-        normals points towards the camera. Only guaranteed to work for triangles.'''
+        normals points towards the camera. All triangles are checked at once.'''
         self.indices = {}
-        for key, val in self.index_array.items():
-            self.indices[key] = []
-            for indices in val:
-
-                face_normal = np.cross(self.vertices[indices[2]] - self.vertices[indices[0]],
-                                                     self.vertices[indices[1]] - self.vertices[indices[0]])
-                avg_normal = np.sum(self.normals[indices], axis=0)
-                if np.dot(avg_normal, face_normal)  > 0:
-                    indices[2], indices[1] = indices[1], indices[2]
-                self.indices[key].extend(indices)
+        for key, triangles in self.index_array.items():
+            triangles = triangles.copy()
+            corners = [self.vertices[triangles[:, i]] for i in range(3)]
+            face_normals = np.cross(corners[2] - corners[0], corners[1] - corners[0])
+            avg_normals = np.sum(self.normals[triangles], axis=1)
+            swap = np.sum(avg_normals*face_normals, axis=1) > 0
+            triangles[swap, 1], triangles[swap, 2] = triangles[swap, 2], triangles[swap, 1]
+            self.indices[key] = triangles.ravel()
 
     def print_out(self):
         for i in range(len(self.vertices)):
@@ -90,13 +244,69 @@ class WaveParser:
         print self.indices
 
 
+_line_codes = {'v': 1, 'vt': 2, 'vn': 3, 'f': 4, 'o': 5}
+
+def _parse_floats(texts, width):
+    '''first width numbers of each text, as a (len(texts), width) array'''
+    values = np.fromstring(' '.join(texts), sep=' ')
+    for found in (width, width + 1):
+        if len(values) == found*len(texts):
+            return values.reshape(-1, found)[:, :width]
+    #lines with differing numbers of values, such as optional w components
+    return np.array([[float(val) for val in text.split()[:width]] for text in texts])
+
+def _parse_faces(texts):
+    '''
+    Parameters:
+        texts (list of str): the corners of each f line, e.g. "1/1/1 2/2/2 3/3/3"
+    Returns: (corners, values): corners per face, and a (sum(corners), 3) int array of
+        1-based v, vt, vn indices for every corner, with 0 for missing ones
+    '''
+    tokens = [text.split() for text in texts]
+    corners = np.array([len(token) for token in tokens])
+    if not corners.any():
+        return corners, np.zeros((0, 3), dtype=np.int64)
+    first = [token for token in tokens if token][0][0].replace('//', '/0/')
+    width = first.count('/') + 1
+    values = np.fromstring(
+        ' '.join(texts).replace('//', '/0/').replace('/', ' '), dtype=np.int64, sep=' ')
+    if len(values) == corners.sum()*width:
+        values = values.reshape(-1, width)
+    else:
+        #corners written in mixed formats
+        width = 3
+        values = np.array([[int(val or 0) for val in (corner.split('/') + ['', ''])[:3]]
+                           for token in tokens for corner in token], dtype=np.int64)
+    padded = np.zeros((len(values), 3), dtype=np.int64)
+    padded[:, :width] = values
+    return corners, padded
+
+def _fan_triangulate(values, corners, face_objects):
+    '''
+    Split each face into triangles that share its first corner
+    Returns: ((triangles, 3, 3) corner array, object of each triangle)
+    '''
+    counts = np.maximum(corners - 2, 0)
+    starts = np.cumsum(corners) - corners
+    faces = np.repeat(np.arange(len(corners)), counts)
+    step = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    first = starts[faces]
+    triangles = values[np.stack([first, first + step, first + step + 1], axis=1)]
+    return triangles, face_objects[faces]
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as mfile:
+        for block in iter(lambda: mfile.read(2**20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
 def listround(mlist, digits=0):
     return [round(v, digits) for v in mlist]
 
 def test():
     parser = WaveParser()
-    with open('imagery/book.obj') as book:
-        parser.parse(book)
+    parser.load('imagery/book.obj')
     vertices = 500*parser.vertices
     normals = parser.normals
     tex_coords = parser.tex_coords